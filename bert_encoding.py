@@ -0,0 +1,701 @@
+import os
+import json
+import shutil
+import argparse
+import numpy as np
+import torch
+import torch.utils.data as data
+from collections import deque
+from itertools import chain, islice
+from multiprocessing import Pool, cpu_count
+from time import perf_counter
+from pandas import read_csv
+from util import iter_txt_df, file_fingerprint, cache_key, balanced_weights
+
+
+# arrays written for every chunk of a note, input_ids and attn_masks are sequence_len wide
+ARRAYS = {
+    'input_ids':np.int32,
+    'attn_masks':np.int8,
+    'patient_ids':np.int64,
+    'labels':np.int64
+}
+# arrays written for every note, so that the number of sequences of any chunking settings can be reported
+NOTE_ARRAYS = {
+    'note_lengths':np.int64,
+    'note_patient_ids':np.int64
+}
+META_FILE = 'meta.json'
+POLICIES = ['head', 'tail', 'head+tail', 'all']
+
+# set once per worker process by _init_worker
+TOKENIZER = None
+
+
+def _init_worker(tokenizer):
+    global TOKENIZER
+    # each process runs single-threaded, the parallelism comes from the pool
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+    TOKENIZER = tokenizer
+
+
+def select_windows(lengths, body_len, stride=0, policy='all', max_note_chunks=None):
+    '''
+    Splits notes of the given token lengths into windows of body_len tokens, consecutive windows
+    sharing stride tokens (as in the tokenizers' stride argument). The last window of a note is
+    aligned with its end, so every window but that of a short note is full. policy picks which
+    windows are kept: the first (head), the last (tail), both (head+tail) or all of them, and at
+    most max_note_chunks of those are kept from the start of the note. Returns the note index and start of each window.
+    '''
+    if policy not in POLICIES:
+        raise NameError('invalid string passed to chunk policy argument')
+    if not 0 <= stride < body_len:
+        raise ValueError('the stride has to be at least 0 and less than the number of tokens per sequence')
+    lengths = np.asarray(lengths, dtype=np.int64)
+    step = body_len-stride
+    # ceiling division: windows needed to cover each note
+    n_windows = 1+np.maximum(0, -(-(lengths-body_len)//step))
+    if policy == 'all':
+        counts = n_windows
+    elif policy == 'head+tail':
+        counts = np.minimum(n_windows, 2)
+    else:
+        counts = np.ones(len(lengths), dtype=np.int64)
+    if max_note_chunks is not None:
+        counts = np.minimum(counts, max_note_chunks)
+
+    note = np.repeat(np.arange(len(lengths)), counts)
+    rank = np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts, counts)
+    last_start = np.maximum(0, lengths-body_len)[note]
+    if policy == 'tail':
+        start = last_start
+    elif policy == 'head+tail':
+        start = np.where(rank == 0, 0, last_start)
+    else:
+        start = np.minimum(rank*step, last_start)
+
+    return note, start
+
+
+def window_counts(lengths, body_len, stride=0, policy='all', max_note_chunks=None):
+    '''Number of windows kept for each note by select_windows'''
+    note, _ = select_windows(lengths, body_len, stride, policy, max_note_chunks)
+    return np.bincount(note, minlength=len(lengths))
+
+
+def build_sequences(token_ids, seq_len, cls_id, sep_id, pad_id, stride=0, policy='all', max_note_chunks=None):
+    '''
+    Builds the padded [CLS] ... [SEP] sequences and attention masks of the windows of each note (lists of
+    token IDs without special tokens) in one go, gathering the windows' tokens from the flattened notes.
+    Returns the input IDs, attention masks and the note index of each sequence.
+    '''
+    body_len = seq_len-2
+    lengths = np.fromiter(map(len, token_ids), dtype=np.int64, count=len(token_ids))
+    offsets = np.r_[0, np.cumsum(lengths)]
+    flat = np.fromiter(chain.from_iterable(token_ids), dtype=np.int32, count=int(offsets[-1]))
+    note, start = select_windows(lengths, body_len, stride, policy, max_note_chunks)
+
+    n = len(note)
+    n_body = np.minimum(lengths[note]-start, body_len)
+    cols = np.arange(body_len)
+    in_window = cols[None, :] < n_body[:, None]
+    input_ids = np.full((n, seq_len), pad_id, dtype=np.int32)
+    input_ids[:, 0] = cls_id
+    if len(flat) > 0:
+        positions = np.minimum((offsets[note]+start)[:, None]+cols[None, :], len(flat)-1)
+        input_ids[:, 1:body_len+1] = np.where(in_window, flat[positions], pad_id)
+    input_ids[np.arange(n), n_body+1] = sep_id
+    attn_masks = (np.arange(seq_len)[None, :] < (n_body+2)[:, None]).astype(np.int8)
+
+    return input_ids, attn_masks, note
+
+
+def _encode_chunk(notes, patient_ids, labels, seq_len, stride, policy, max_note_chunks):
+    '''Tokenizes a chunk of notes with the fast tokenizer and splits them into sequences of seq_len tokens'''
+    token_ids = TOKENIZER(
+        notes,
+        add_special_tokens=False,
+        return_attention_mask=False,
+        return_token_type_ids=False,
+        verbose=False
+    )['input_ids']
+    input_ids, attn_masks, note_of_seq = build_sequences(
+        token_ids, seq_len, TOKENIZER.cls_token_id, TOKENIZER.sep_token_id, TOKENIZER.pad_token_id,
+        stride=stride, policy=policy, max_note_chunks=max_note_chunks
+    )
+
+    return {
+        'input_ids':input_ids,
+        'attn_masks':attn_masks,
+        'patient_ids':patient_ids[note_of_seq],
+        'labels':labels[note_of_seq],
+        'note_lengths':np.fromiter(map(len, token_ids), dtype=np.int64, count=len(token_ids)),
+        'note_patient_ids':patient_ids
+    }
+
+
+def cap_per_patient(patient_ids, max_patient_chunks):
+    '''
+    Positions of the sequences kept when each patient is limited to their last max_patient_chunks
+    sequences in file order (the notes closest to discharge when the notes are in chart order)
+    '''
+    patient_ids = np.asarray(patient_ids)
+    order = np.argsort(patient_ids, kind='mergesort')
+    sorted_ids = patient_ids[order]
+    # rank of each sequence counted from the last one of its patient
+    group_end = np.r_[np.flatnonzero(sorted_ids[1:] != sorted_ids[:-1]), len(sorted_ids)-1]
+    ends = np.repeat(group_end, np.diff(np.r_[-1, group_end]))
+    keep = order[(ends-np.arange(len(order))) < max_patient_chunks]
+
+    return np.sort(keep)
+
+
+def chunk_report(path, seq_len=None, stride=0, max_note_chunks=None, max_patient_chunks=None):
+    '''
+    Number of sequences each chunking policy would produce for an encoded notes file, from the token
+    counts of its notes, without tokenizing again
+    '''
+    with open(os.path.join(path, META_FILE), 'r') as f:
+        meta = json.load(f)
+    lengths = np.fromfile(os.path.join(path, 'note_lengths.bin'), dtype=NOTE_ARRAYS['note_lengths'])
+    patients = np.fromfile(os.path.join(path, 'note_patient_ids.bin'), dtype=NOTE_ARRAYS['note_patient_ids'])
+    body_len = (seq_len or meta['sequence_len'])-2
+
+    report = {}
+    for policy in POLICIES:
+        counts = window_counts(lengths, body_len, stride, policy, max_note_chunks)
+        if max_patient_chunks is not None:
+            _, codes = np.unique(patients, return_inverse=True)
+            report[policy] = int(np.minimum(np.bincount(codes, weights=counts), max_patient_chunks).sum())
+        else:
+            report[policy] = int(counts.sum())
+
+    return report
+
+
+def encoding_path(cache_dir, notes_fp, readm_fp, bert_model, txtvar, st_aug, seq_len, stride=0, policy='all',
+                  max_note_chunks=None, nrows=None):
+    '''Directory of the encoded sequences of one notes file with one tokenizer and set of chunking settings'''
+    key = cache_key(
+        inputs=[file_fingerprint(notes_fp), file_fingerprint(readm_fp)],
+        bert_model=bert_model,
+        txtvar=txtvar,
+        st_aug=st_aug,
+        seq_len=seq_len,
+        stride=stride,
+        policy=policy,
+        max_note_chunks=max_note_chunks,
+        nrows=nrows
+    )
+
+    return os.path.join(cache_dir, 'bert_'+key)
+
+
+def encode(notes_fp, readm_fp, out_dir, bert_model, txtvar, st_aug, seq_len, stride=0, policy='all',
+           max_note_chunks=None, workers=1, chunksize=1000, nrows=None):
+    '''
+    Tokenizes the notes of the labelled patients once, in a pool of processes, splits them into sequences
+    (see select_windows) and appends the input IDs, attention masks, patient IDs and labels of every sequence
+    to flat binary files that EncodedDataset memory-maps. Chunks of notes are written in order and only a
+    bounded number are in flight at a time.
+    '''
+    from transformers import BertTokenizerFast
+
+    # loaded here so that a bad model name fails in this process rather than in every worker
+    tokenizer = BertTokenizerFast.from_pretrained(bert_model, do_lower_case=True)
+    readm_df = read_csv(readm_fp, index_col=0)
+    # a patient list without labels (e.g. for scoring new patients) gets the label -1
+    readm_labels = readm_df.READM.values if 'READM' in readm_df.columns else np.full(len(readm_df), -1)
+
+    # written to a temporary directory first so that an interrupted run isn't mistaken for a finished one,
+    # one per process in case several runs share the cache
+    tmp_dir = '{}.tmp{}'.format(out_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    dtypes = dict(ARRAYS, **NOTE_ARRAYS)
+    files = dict((name, open(os.path.join(tmp_dir, name+'.bin'), 'wb')) for name in dtypes)
+    n_seqs, n_notes = 0, 0
+    max_pending = 2*workers
+    pending = deque()
+    with Pool(workers, initializer=_init_worker, initargs=(tokenizer,)) as pool:
+
+        def _write_next():
+            nonlocal n_seqs
+            encoded = pending.popleft().get()
+            for name, f in files.items():
+                encoded[name].astype(dtypes[name]).tofile(f)
+            n_seqs += len(encoded['labels'])
+
+        for chunk in iter_txt_df(notes_fp, txtvar, st_aug, chunksize, subject_ids=readm_df.index.values):
+            if nrows is not None:
+                chunk = chunk.iloc[:nrows-n_notes]
+            rows = readm_df.index.get_indexer(chunk.SUBJECT_ID.values)
+            chunk = chunk[rows >= 0]
+            notes = chunk[txtvar]+chunk.SEMTYPES if st_aug else chunk[txtvar]
+            pending.append(pool.apply_async(_encode_chunk, (
+                notes.astype(str).tolist(),
+                chunk.SUBJECT_ID.values.astype(np.int64),
+                readm_labels[rows[rows >= 0]],
+                seq_len,
+                stride,
+                policy,
+                max_note_chunks
+            )))
+            n_notes += len(chunk)
+            if len(pending) >= max_pending:
+                _write_next()
+            if nrows is not None and n_notes >= nrows:
+                break
+        while pending:
+            _write_next()
+
+    for f in files.values():
+        f.close()
+    with open(os.path.join(tmp_dir, META_FILE), 'w+') as f:
+        json.dump({'notes':os.path.abspath(notes_fp), 'labels':os.path.abspath(readm_fp), 'bert_model':bert_model,
+                   'txtvar':txtvar, 'st_aug':st_aug, 'sequence_len':seq_len, 'stride':stride, 'policy':policy,
+                   'max_note_chunks':max_note_chunks, 'n_notes':n_notes, 'n_sequences':n_seqs}, f, indent=1)
+    if os.path.exists(os.path.join(out_dir, META_FILE)):
+        # another process finished the same encoding first, which is kept as it may already be in use
+        shutil.rmtree(tmp_dir)
+        return out_dir
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir, out_dir)
+
+    return out_dir
+
+
+def load_or_encode(cache_dir, notes_fp, readm_fp, bert_model, txtvar, st_aug, seq_len, stride=0, policy='all',
+                   max_note_chunks=None, max_patient_chunks=None, workers=1, nrows=None, verbose=False):
+    '''Dataset of the sequences of a notes file, encoded once with these settings and cached in cache_dir.
+    Under DDP only the first process encodes them, the others wait for it (every process has to call this).'''
+    path = encoding_path(
+        cache_dir, notes_fp, readm_fp, bert_model, txtvar, st_aug, seq_len, stride, policy, max_note_chunks, nrows
+    )
+    distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+    if not distributed or torch.distributed.get_rank() == 0:
+        if not os.path.exists(os.path.join(path, META_FILE)):
+            if verbose:
+                print('Encoding {} into {}...'.format(notes_fp, path))
+            encode(
+                notes_fp, readm_fp, path, bert_model, txtvar, st_aug, seq_len, stride=stride, policy=policy,
+                max_note_chunks=max_note_chunks, workers=workers, nrows=nrows
+            )
+        elif verbose:
+            print('Loading encoded sequences from {}...'.format(path))
+    if distributed:
+        # reached by every process whether or not the sequences were cached, so that none waits forever
+        torch.distributed.barrier()
+
+    dataset = EncodedDataset(path)
+    if max_patient_chunks is not None:
+        # the per-patient cap only selects sequences, so it doesn't need an encoding of its own
+        dataset = dataset.subset(cap_per_patient(dataset.patient_ids, max_patient_chunks))
+
+    return dataset
+
+
+class EncodedDataset(data.Dataset):
+    '''
+    Dataset of the sequences written by encode(). The arrays are memory-mapped, so DataLoader worker
+    processes share the same pages rather than each holding a copy of the corpus. Batches of indices
+    (from torch's auto-batching) are gathered with one indexing operation per array in __getitems__,
+    into contiguous arrays only as wide as the longest sequence of the batch, and a contiguous range of
+    full-length sequences is served as a view of the map without copying.
+    '''
+
+    def __init__(self, path, index=None):
+        self.path = path
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            meta = json.load(f)
+        self.sequence_len = meta['sequence_len']
+        n = meta['n_sequences']
+        self.arrays = {}
+        for name, dtype in ARRAYS.items():
+            shape = (n, self.sequence_len) if name in ['input_ids', 'attn_masks'] else (n,)
+            # copy-on-write so that torch can wrap the arrays, the files themselves are never changed
+            self.arrays[name] = np.memmap(os.path.join(path, name+'.bin'), dtype=dtype, mode='c', shape=shape)\
+                if n > 0 else np.zeros(shape, dtype=dtype)
+        # positions of the sequences of this dataset in the files, None for all of them
+        self.index = None if index is None else np.asarray(index, dtype=np.int64)
+        self._lengths = None
+
+    def __getstate__(self):
+        # only the path is pickled (e.g. for spawned DataLoader workers), the files are mapped again on the other side,
+        # along with the sequence lengths if they've been summed already
+        return {'path':self.path, 'index':self.index, 'lengths':self._lengths}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['index'])
+        self._lengths = state.get('lengths')
+
+    def __len__(self):
+        return len(self.arrays['labels']) if self.index is None else len(self.index)
+
+    def subset(self, idx):
+        '''Dataset of the sequences at positions idx of this one, sharing its maps'''
+        subset = object.__new__(EncodedDataset)
+        subset.__dict__.update(self.__dict__)
+        subset.index = self._rows(idx)
+
+        return subset
+
+    def _rows(self, idx):
+        return np.asarray(idx, dtype=np.int64) if self.index is None else self.index[idx]
+
+    @property
+    def labels(self):
+        return np.asarray(self.arrays['labels']) if self.index is None else self.arrays['labels'][self.index]
+
+    @property
+    def patient_ids(self):
+        return np.asarray(self.arrays['patient_ids']) if self.index is None else self.arrays['patient_ids'][self.index]
+
+    def _file_lengths(self):
+        if self._lengths is None:
+            # summed from the attention masks a block at a time, once for all subsets made after this
+            masks = self.arrays['attn_masks']
+            self._lengths = np.concatenate(
+                [np.zeros(0, dtype=np.int64)]+[masks[i:i+2**16].sum(1) for i in range(0, len(masks), 2**16)]
+            )
+        return self._lengths
+
+    @property
+    def lengths(self):
+        '''Number of real (unpadded) tokens of each sequence'''
+        return self._file_lengths() if self.index is None else self._file_lengths()[self.index]
+
+    def _gather(self, rows, trim=True):
+        if rows.ndim == 0:
+            return dict((name, torch.from_numpy(np.asarray(a[rows]))) for name, a in self.arrays.items())
+        # a batch only needs the columns up to its longest sequence, which are copied straight into
+        # contiguous arrays of that size rather than gathered whole and cut down afterwards; untrimmed
+        # gathers keep the sequence length, so that they can be concatenated with others
+        if not trim:
+            n = self.sequence_len
+        else:
+            n = max(int(self._file_lengths()[rows].max()), 1) if len(rows) > 0 else 1
+        if len(rows) > 1 and rows[-1]-rows[0] == len(rows)-1 and (np.diff(rows) == 1).all():
+            rows = slice(rows[0], rows[-1]+1)
+        return dict(
+            (name, torch.from_numpy(np.ascontiguousarray(a[rows, :n] if a.ndim == 2 else a[rows])))
+            for name, a in self.arrays.items()
+        )
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+
+        return self._gather(self._rows(idx))
+
+    def __getitems__(self, idx):
+        return self._gather(self._rows(idx))
+
+
+def collate(batch):
+    '''DataLoader collate function for EncodedDataset: batches gathered by __getitems__ are passed through,
+    lists of single sequences (torch versions without __getitems__) are stacked'''
+    if isinstance(batch, dict):
+        return batch
+    return data.dataloader.default_collate(batch)
+
+
+def collate_dynamic(batch):
+    '''Same as collate, but the sequences are cut down to the longest one in the batch, so the model
+    doesn't spend time on columns that are padding in every sequence'''
+    batch = collate(batch)
+    n = max(int(batch['attn_masks'].sum(1).max()), 1) if len(batch['attn_masks']) > 0 else 1
+    # cached hidden states (see bert_features.CachedDataset) are padded like the input IDs
+    for name in ['input_ids', 'attn_masks', 'hidden_states']:
+        if name in batch:
+            batch[name] = batch[name][:, :n]
+
+    return batch
+
+
+class PatientDataset(data.Dataset):
+    '''
+    Patient-level view of an EncodedDataset: item i is every sequence of the i-th patient (the last
+    max_chunks of them at most, in encoding order), with the patient's label once. With features (a
+    bert_features.SequenceFeatures of the same encoding) items hold the cached features of the
+    sequences instead of their tokens. Batches of patients are gathered in one go by __getitems__,
+    chunk_counts says how many consecutive rows of a batch belong to each patient.
+    '''
+
+    def __init__(self, dataset, max_chunks=None, features=None):
+        self.dataset = dataset
+        self.features = features
+        rows = dataset._rows(np.arange(len(dataset)))
+        patient_ids = dataset.patient_ids
+        order = np.argsort(patient_ids, kind='mergesort')
+        if max_chunks is not None:
+            order = order[cap_per_patient(patient_ids[order], max_chunks)]
+        sorted_ids = patient_ids[order]
+        starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]]) if len(order) > 0\
+            else np.zeros(0, dtype=np.int64)
+        # rows of the encoding of each patient's sequences, one patient after the other
+        self.rows = rows[order]
+        self.starts = starts
+        self.counts = np.diff(np.r_[starts, len(order)])
+        self.patients = sorted_ids[starts]
+        self.patient_labels = dataset.labels[order[starts]] if len(order) > 0 else np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.patients)
+
+    @property
+    def labels(self):
+        return self.patient_labels
+
+    @property
+    def patient_ids(self):
+        return self.patients
+
+    @property
+    def lengths(self):
+        '''Number of sequences of each patient, so that BucketBatchSampler batches patients with similar numbers'''
+        return self.counts
+
+    def _gather(self, idx, trim=True):
+        idx = np.asarray(idx, dtype=np.int64)
+        counts = self.counts[idx]
+        # positions in self.rows of the sequences of the patients, in one indexing operation
+        ends = np.cumsum(counts)
+        positions = np.arange(ends[-1] if len(ends) > 0 else 0)+np.repeat(self.starts[idx]-(ends-counts), counts)
+        rows = self.rows[positions]
+        if self.features is not None:
+            batch = {'features':self.features.take(rows)}
+        else:
+            batch = self.dataset._gather(rows, trim)
+            del batch['labels'], batch['patient_ids']
+        batch['chunk_counts'] = torch.from_numpy(counts)
+        batch['labels'] = torch.from_numpy(self.patient_labels[idx])
+        batch['patient_ids'] = torch.from_numpy(self.patients[idx])
+
+        return batch
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+
+        # single patients keep the full sequence length, collate_patients trims the batch
+        return self._gather([idx], trim=False)
+
+    def __getitems__(self, idx):
+        return self._gather(idx)
+
+
+def collate_patients(batch):
+    '''DataLoader collate function for PatientDataset: batches gathered by __getitems__ are passed through,
+    lists of single patients (torch versions without __getitems__, padded to the sequence length) are
+    concatenated, and the sequences are cut down to the longest one in the batch as in collate_dynamic'''
+    if not isinstance(batch, dict):
+        batch = dict((k, torch.cat([b[k] for b in batch], 0)) for k in batch[0])
+    if 'attn_masks' in batch:
+        batch = collate_dynamic(batch)
+
+    return batch
+
+
+class PatientSampler(data.Sampler):
+    '''
+    Draws the training sequences of each epoch so that readmitted patients aren't drowned out by the
+    others. With mode='weighted' num_samples sequences are drawn with replacement in proportion to
+    util.balanced_weights (every class the same total weight, split evenly between the sequences of a
+    patient); with mode='subsample' every sequence of the positive patients is kept along with those of
+    neg_ratio randomly chosen negative patients per positive one. Like DistributedSampler, the draw is
+    seeded by the epoch (see set_epoch) and split between num_replicas processes.
+    '''
+
+    def __init__(self, labels, patient_ids, mode='weighted', num_samples=None, neg_ratio=1.0, num_replicas=1, rank=0,
+                 seed=0):
+        if mode not in ['weighted', 'subsample']:
+            raise NameError('invalid string passed to sampling mode argument')
+        self.labels = np.asarray(labels)
+        self.patient_ids = np.asarray(patient_ids)
+        self.mode = mode
+        self.num_samples = len(self.labels) if num_samples is None else int(num_samples)
+        self.neg_ratio = neg_ratio
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self._drawn = None
+        if mode == 'weighted':
+            weights = balanced_weights(self.labels, self.patient_ids)
+            self.p = weights/weights.sum()
+        else:
+            patients, self.patient_codes = np.unique(self.patient_ids, return_inverse=True)
+            patient_labels = np.zeros(len(patients), dtype=self.labels.dtype)
+            patient_labels[self.patient_codes] = self.labels
+            self.positive_patients = np.flatnonzero(patient_labels > 0)
+            self.negative_patients = np.flatnonzero(patient_labels <= 0)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _draw(self):
+        # drawn once per epoch, as __len__ needs the size of the subsample
+        if self._drawn is not None and self._drawn[0] == self.epoch:
+            return self._drawn[1]
+        rng = np.random.RandomState(self.seed+self.epoch)
+        if self.mode == 'weighted':
+            idx = rng.choice(len(self.labels), size=self.num_samples, replace=True, p=self.p)
+        else:
+            n_neg = min(len(self.negative_patients), int(round(self.neg_ratio*len(self.positive_patients))))
+            keep = np.r_[self.positive_patients, rng.choice(self.negative_patients, n_neg, replace=False)]
+            idx = rng.permutation(np.flatnonzero(np.isin(self.patient_codes, keep)))
+        # every process gets the same number, repeating the first few if need be
+        per_replica = -(-len(idx)//self.num_replicas)
+        idx = np.resize(idx, per_replica*self.num_replicas)[self.rank::self.num_replicas]
+        self._drawn = (self.epoch, idx)
+
+        return idx
+
+    def __iter__(self):
+        yield from self._draw().tolist()
+        # a new draw next time even when nothing calls set_epoch (i.e. without BucketBatchSampler)
+        self.epoch += 1
+
+    def __len__(self):
+        return len(self._draw())
+
+
+class BucketBatchSampler(data.Sampler):
+    '''
+    Batch sampler that groups sequences of similar length, so that with collate_dynamic each batch
+    is only padded to the length of its own longest sequence. Indices are drawn from sampler in pools
+    of bucket_size_multiplier batches, each pool is sorted by length and cut into batches, and with
+    shuffle the order of the batches of a pool is shuffled so that training doesn't see them from
+    shortest to longest.
+    '''
+
+    def __init__(self, sampler, lengths, batch_size, drop_last=False, bucket_size_multiplier=100, shuffle=True):
+        self.sampler = sampler
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.pool_size = batch_size*bucket_size_multiplier
+        self.shuffle = shuffle
+        self.epoch = 0
+
+    def _batches(self, pool):
+        pool = np.asarray(pool, dtype=np.int64)
+        pool = pool[np.argsort(self.lengths[pool], kind='mergesort')]
+        batches = [pool[i:i+self.batch_size].tolist() for i in range(0, len(pool), self.batch_size)]
+        if self.drop_last and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        order = torch.randperm(len(batches)).tolist() if self.shuffle else range(len(batches))
+
+        return [batches[i] for i in order]
+
+    def __iter__(self):
+        # distributed samplers shuffle by epoch, which the trainer can't set through a batch sampler
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(self.epoch)
+            self.epoch += 1
+        pool = []
+        for idx in self.sampler:
+            pool.append(idx)
+            if len(pool) == self.pool_size:
+                yield from self._batches(pool)
+                pool = []
+        if len(pool) > 0:
+            yield from self._batches(pool)
+
+    def __len__(self):
+        # pools hold a whole number of batches, so only the last one can end with a partial batch
+        if self.drop_last:
+            return len(self.sampler)//self.batch_size
+        return (len(self.sampler)+self.batch_size-1)//self.batch_size
+
+
+def loader_worker_init(worker_id):
+    # DataLoader workers only gather and copy arrays, single-threaded so they don't compete with the model's threads
+    torch.set_num_threads(1)
+
+
+def loader_kwargs(workers, pin_memory=False, prefetch_factor=2, persistent_workers=True):
+    '''DataLoader arguments for a number of worker processes, the worker-only ones only when there are workers'''
+    kwargs = {'num_workers':workers, 'pin_memory':pin_memory}
+    if workers > 0:
+        kwargs.update(
+            worker_init_fn=loader_worker_init,
+            prefetch_factor=prefetch_factor,
+            persistent_workers=persistent_workers
+        )
+    return kwargs
+
+
+def probe_loader(dataset, batch_size, collate_fn, workers=None, n_batches=50, tol=0.1, pin_memory=False,
+                 prefetch_factor=2, verbose=False):
+    '''
+    Times how many batches per second of random sequences of dataset a DataLoader delivers with each
+    number of workers (by default 0, 1, 2, 4 and 8 up to half the CPUs), after a first batch that
+    includes starting them, and picks the fewest workers within tol of the fastest. Returns that
+    number and the batches per second of each.
+    '''
+    if workers is None:
+        workers = [w for w in [0, 1, 2, 4, 8] if w <= max(1, cpu_count()//2)]
+    results = {}
+    for w in workers:
+        loader = data.DataLoader(
+            dataset,
+            batch_sampler=data.BatchSampler(data.RandomSampler(dataset), batch_size, drop_last=False),
+            collate_fn=collate_fn,
+            **loader_kwargs(w, pin_memory, prefetch_factor, persistent_workers=False)
+        )
+        batches = iter(loader)
+        next(batches, None)
+        start = perf_counter()
+        n = sum(1 for _ in islice(batches, n_batches))
+        results[w] = n/max(perf_counter()-start, 1e-9)
+        del batches
+        if verbose:
+            print('{} loader workers: {:.1f} batches/s'.format(w, results[w]))
+    best = max(results.values())
+    chosen = min(w for w, rate in results.items() if rate >= (1-tol)*best)
+
+    return chosen, results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''Tokenizes a notes file for the BERT model ahead of training,
+        into the cache directory that MIMICBERTReadmissionPredictor reads from''')
+    parser.add_argument('notes_fp', type=str)
+    parser.add_argument('readm_fp', type=str)
+    parser.add_argument('bert_model', type=str)
+    parser.add_argument('txtvar', type=str)
+    parser.add_argument('cache_dir', type=str)
+    parser.add_argument('--st_aug', action='store_true')
+    parser.add_argument('--sequence_len', type=int, default=256)
+    parser.add_argument('--stride', type=int, default=0, help='number of tokens shared by consecutive chunks of a note')
+    parser.add_argument('--policy', type=str, default='all', choices=POLICIES,
+        help='which chunks of each note are kept')
+    parser.add_argument('--max_note_chunks', type=int, default=None, help='maximum number of chunks kept per note')
+    parser.add_argument('--max_patient_chunks', type=int, default=None,
+        help='maximum number of chunks kept per patient (the last ones)')
+    parser.add_argument('--report', action='store_true',
+        help='print the number of chunks each policy gives with these settings')
+    parser.add_argument('--workers', type=int, default=cpu_count())
+    parser.add_argument('--probe_batch', type=int, default=None,
+        help='time the DataLoader with different numbers of workers on batches of this many sequences')
+    args = parser.parse_args()
+
+    dataset = load_or_encode(
+        args.cache_dir, args.notes_fp, args.readm_fp, args.bert_model, args.txtvar, args.st_aug, args.sequence_len,
+        stride=args.stride, policy=args.policy, max_note_chunks=args.max_note_chunks,
+        max_patient_chunks=args.max_patient_chunks, workers=args.workers, verbose=True
+    )
+    print('{} sequences'.format(len(dataset)))
+    if args.report:
+        report = chunk_report(
+            dataset.path, stride=args.stride, max_note_chunks=args.max_note_chunks,
+            max_patient_chunks=args.max_patient_chunks
+        )
+        print('Chunks per policy:')
+        for policy, n in report.items():
+            print('{:>10} {}'.format(policy, n))
+    if args.probe_batch is not None:
+        workers, _ = probe_loader(dataset, args.probe_batch, collate_dynamic, verbose=True)
+        print('Suggested loader workers: {}'.format(workers))
@@ -0,0 +1,246 @@
+import os
+import json
+import shutil
+import argparse
+import numpy as np
+import torch
+import torch.utils.data as data
+from util import cache_key
+from bert_encoding import EncodedDataset, BucketBatchSampler, collate_dynamic
+
+
+FEATURES_FILE = 'features.f16'
+META_FILE = 'meta.json'
+
+# torch.inference_mode only exists from torch 1.9
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+
+def features_path(cache_dir, encoded_path, bert_model, n_layers=None):
+    '''
+    Directory of the features of one set of encoded sequences (see bert_encoding.encoding_path, whose key
+    covers the model, text variable and sequence length) under one pre-trained model: the final [CLS]
+    embeddings, or with n_layers the hidden states of every token after the first n_layers layers
+    '''
+    key = cache_key(
+        encoding=os.path.basename(os.path.normpath(encoded_path)),
+        bert_model=bert_model,
+        features='cls' if n_layers is None else 'layer{}'.format(n_layers),
+        layout='flat'
+    )
+
+    return os.path.join(cache_dir, 'features_'+key)
+
+
+def run_layers(layers, hidden_states, attn_masks):
+    '''Runs hidden states through BERT encoder layers, masking the padding as BertModel does'''
+    # the additive mask the layers take, 0 for tokens and the lowest float for padding
+    mask = (1.0-attn_masks[:, None, None, :].to(hidden_states.dtype))*torch.finfo(hidden_states.dtype).min
+    for layer in layers:
+        hidden_states = layer(hidden_states, mask)
+        # tuples in older transformers versions
+        hidden_states = hidden_states[0] if isinstance(hidden_states, tuple) else hidden_states
+
+    return hidden_states
+
+
+def _positions(offsets, rows):
+    # positions in a flat file of the ranges offsets[rows] to offsets[rows+1], one after the other
+    lengths = offsets[rows+1]-offsets[rows]
+    ends = np.cumsum(lengths)
+
+    return np.arange(ends[-1] if len(ends) > 0 else 0)+np.repeat(offsets[rows]-(ends-lengths), lengths), lengths
+
+
+def embed(encoder, encoded_path, out_dir, batch_size=64, n_layers=None):
+    '''
+    Runs the (frozen) BERT encoder once over every sequence of an encoding and writes, in the order of the
+    encoding, either the final [CLS] embedding of each sequence or, with n_layers, the hidden states of
+    its tokens after the embeddings and the first n_layers encoder layers (the later layers aren't run).
+    Hidden states are only written for real tokens, one sequence after the other, to a flat float16 file
+    that SequenceFeatures memory-maps. Sequences are batched by length and padded per batch.
+    '''
+    dataset = EncodedDataset(encoded_path)
+    batches = BucketBatchSampler(data.SequentialSampler(dataset), dataset.lengths, batch_size, shuffle=False)
+    hidden_size = encoder.config.hidden_size
+    device = next(encoder.parameters()).device
+    lengths = np.ones(len(dataset), dtype=np.int64) if n_layers is None else dataset.lengths.astype(np.int64)
+    offsets = np.r_[0, np.cumsum(lengths)].astype(np.int64)
+
+    # written to a temporary directory first so that an interrupted run isn't mistaken for a finished one,
+    # one per process in case several runs share the cache
+    tmp_dir = '{}.tmp{}'.format(out_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    shape = (int(offsets[-1]), hidden_size)
+    features = np.memmap(os.path.join(tmp_dir, FEATURES_FILE), dtype=np.float16, mode='w+', shape=shape)\
+        if shape[0] > 0 else np.zeros(shape, dtype=np.float16)
+    was_training = encoder.training
+    encoder.eval()
+    with inference_mode():
+        for rows in batches:
+            batch = collate_dynamic(dataset.__getitems__(rows))
+            input_ids, attn_masks = batch['input_ids'].long().to(device), batch['attn_masks'].to(device)
+            if n_layers is None:
+                out = encoder(input_ids, attn_masks.float())[0][:, 0]
+            else:
+                hidden_states = run_layers(
+                    encoder.encoder.layer[:n_layers], encoder.embeddings(input_ids=input_ids), attn_masks
+                )
+                # padding is dropped, masks are 1 for the first length tokens of each sequence
+                out = hidden_states[attn_masks.bool()]
+            features[_positions(offsets, np.asarray(rows, dtype=np.int64))[0]] = out.float().cpu().numpy()
+    encoder.train(was_training)
+    if isinstance(features, np.memmap):
+        features.flush()
+    del features
+
+    np.save(os.path.join(tmp_dir, 'offsets.npy'), offsets)
+    with open(os.path.join(encoded_path, META_FILE), 'r') as f:
+        meta = json.load(f)
+    with open(os.path.join(tmp_dir, META_FILE), 'w+') as f:
+        json.dump({'encoding':os.path.abspath(encoded_path), 'bert_model':meta['bert_model'], 'txtvar':meta['txtvar'],
+                   'sequence_len':meta['sequence_len'], 'features':'cls' if n_layers is None else 'hidden_states',
+                   'n_layers':n_layers, 'n_sequences':len(dataset), 'n_rows':shape[0], 'hidden_size':hidden_size},
+                  f, indent=1)
+    if os.path.exists(os.path.join(out_dir, META_FILE)):
+        # another process finished the same features first, which are kept as they may already be in use
+        shutil.rmtree(tmp_dir)
+        return out_dir
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir, out_dir)
+
+    return out_dir
+
+
+def load_or_embed(cache_dir, dataset, bert_model, encoder, batch_size=64, n_layers=None, verbose=False):
+    '''Features of the sequences of dataset (an EncodedDataset, or a subset of one), computed once for
+    its whole encoding with encoder, the BERT model of the pre-trained bert_model. Under DDP only the
+    first process computes them, the others wait for it (every process has to call this); as that wait is
+    bounded by the process group's timeout, the features are best computed before training starts (see
+    MIMICBERTReadmissionPredictor.prepare_data).'''
+    path = features_path(cache_dir, dataset.path, bert_model, n_layers)
+    distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+    if not distributed or torch.distributed.get_rank() == 0:
+        if not os.path.exists(os.path.join(path, META_FILE)):
+            if verbose:
+                print('Embedding {} into {}...'.format(dataset.path, path))
+            embed(encoder, dataset.path, path, batch_size, n_layers)
+        elif verbose:
+            print('Loading cached features from {}...'.format(path))
+    if distributed:
+        # reached by every process whether or not the features were cached, so that none waits forever
+        torch.distributed.barrier()
+
+    return SequenceFeatures(path)
+
+
+class SequenceFeatures(object):
+    '''Memory-mapped features written by embed(), indexed by the rows of an encoding (i.e. by
+    EncodedDataset._rows): one [CLS] embedding per sequence, or the hidden states of its tokens'''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            meta = json.load(f)
+        self.sequence_len = meta['sequence_len']
+        shape = (meta['n_rows'], meta['hidden_size'])
+        self.features = np.memmap(os.path.join(path, FEATURES_FILE), dtype=np.float16, mode='r', shape=shape)\
+            if shape[0] > 0 else np.zeros(shape, dtype=np.float16)
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+
+    def __getstate__(self):
+        # only the path is pickled (e.g. for spawned DataLoader workers)
+        return {'path':self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def take(self, rows):
+        '''[CLS] embeddings of the sequences at rows of the encoding, as a float32 tensor'''
+        return torch.from_numpy(np.asarray(self.features[self.offsets[rows]], dtype=np.float32))
+
+    def take_padded(self, rows, seq_len=None):
+        '''Hidden states of the sequences at rows of the encoding, as a float32 tensor padded with zeros to
+        the longest of them (or to seq_len), and their attention masks'''
+        rows = np.asarray(rows, dtype=np.int64)
+        positions, lengths = _positions(self.offsets, rows)
+        seq_len = seq_len or (int(lengths.max()) if len(lengths) > 0 else 1)
+        masks = np.arange(seq_len)[None, :] < lengths[:, None]
+        hidden_states = np.zeros((len(rows), seq_len, self.features.shape[1]), dtype=np.float32)
+        hidden_states[masks] = self.features[positions]
+
+        return torch.from_numpy(hidden_states), torch.from_numpy(masks.astype(np.int8))
+
+
+class CachedDataset(data.Dataset):
+    '''
+    The sequences of an EncodedDataset as the hidden states cached in a SequenceFeatures, so that a model
+    whose lower layers are frozen can train from where they stop. Batches are padded to their longest
+    sequence by __getitems__, single sequences to the sequence length (trimmed again by collate_dynamic).
+    '''
+
+    def __init__(self, dataset, features):
+        self.dataset = dataset
+        self.features = features
+
+    def __len__(self):
+        return len(self.dataset)
+
+    @property
+    def labels(self):
+        return self.dataset.labels
+
+    @property
+    def patient_ids(self):
+        return self.dataset.patient_ids
+
+    @property
+    def lengths(self):
+        return self.dataset.lengths
+
+    def _gather(self, idx, seq_len=None):
+        rows = self.dataset._rows(idx)
+        hidden_states, attn_masks = self.features.take_padded(np.atleast_1d(rows), seq_len)
+        batch = {
+            'hidden_states':hidden_states,
+            'attn_masks':attn_masks,
+            'patient_ids':torch.from_numpy(np.atleast_1d(self.dataset.arrays['patient_ids'][rows])),
+            'labels':torch.from_numpy(np.atleast_1d(self.dataset.arrays['labels'][rows]))
+        }
+        if np.ndim(rows) == 0:
+            batch = dict((k, v[0]) for k, v in batch.items())
+        return batch
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+
+        return self._gather(idx, self.features.sequence_len)
+
+    def __getitems__(self, idx):
+        return self._gather(idx)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''Caches the [CLS] embeddings, or the hidden states after the
+        first layers, of an encoding made by bert_encoding.py under a pre-trained BERT model''')
+    parser.add_argument('encoded_path', type=str, help='directory of the encoded sequences')
+    parser.add_argument('bert_model', type=str)
+    parser.add_argument('cache_dir', type=str)
+    parser.add_argument('--n_layers', type=int, default=None,
+        help='cache the hidden states of every token after this many encoder layers, rather than the [CLS] embeddings')
+    parser.add_argument('--batch', type=int, default=64)
+    args = parser.parse_args()
+
+    from transformers import BertModel
+
+    encoder = BertModel.from_pretrained(args.bert_model)
+    features = load_or_embed(
+        args.cache_dir, EncodedDataset(args.encoded_path), args.bert_model, encoder, args.batch, args.n_layers,
+        verbose=True
+    )
+    print('{} sequences'.format(len(features)))
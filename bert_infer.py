@@ -0,0 +1,244 @@
+import os
+import argparse
+import numpy as np
+import torch
+import torch.utils.data as data
+from time import perf_counter
+from pandas import DataFrame
+from transformers import BertForSequenceClassification
+from bert_encoding import load_or_encode, collate_dynamic, BucketBatchSampler, POLICIES
+from patient_pooling import aggregate_patient_logits, LOGIT_POOLINGS
+
+
+# torch.inference_mode only exists from torch 1.9, no_grad does the same job a bit more slowly before that
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+
+def load_model(state_fp, bert_model):
+    '''
+    Loads the weights saved by bert_main.py (the state_dict of MIMICBERTReadmissionPredictor, whose keys
+    are those of the BERT classifier prefixed by "model.") into the BERT classifier, in evaluation mode
+    '''
+    model = BertForSequenceClassification.from_pretrained(bert_model)
+    state = torch.load(state_fp, map_location='cpu')
+    model.load_state_dict(dict((k[len('model.'):], v) for k, v in state.items() if k.startswith('model.')))
+
+    return model.eval()
+
+
+def _logits(out):
+    # tuples from older transformers versions, output objects from newer ones and plain tensors from traced models
+    if isinstance(out, torch.Tensor):
+        return out
+    return out[0] if isinstance(out, (tuple, list)) else out.logits
+
+
+class LogitsOnly(torch.nn.Module):
+    '''The classifier returning a plain logits tensor, which is what tracing and the ONNX exporter need'''
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attn_masks):
+        return _logits(self.model(input_ids, attn_masks))
+
+
+class OnnxModel(object):
+    '''Runs an exported model with onnxruntime behind the same call as the torch models'''
+
+    def __init__(self, onnx_fp, threads):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(onnx_fp, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, input_ids, attn_masks):
+        logits, = self.session.run(None, {'input_ids':input_ids.numpy(), 'attention_mask':attn_masks.numpy()})
+        return torch.from_numpy(logits)
+
+
+def export_torchscript(model, example, export_fp):
+    with inference_mode():
+        traced = torch.jit.trace(LogitsOnly(model).eval(), example)
+    traced = torch.jit.freeze(traced) if hasattr(torch.jit, 'freeze') else traced
+    if export_fp is not None:
+        traced.save(export_fp)
+
+    return traced
+
+
+def export_onnx(model, example, export_fp, quantize):
+    '''Exports the model to ONNX with dynamic batch and sequence dimensions, quantizing the exported
+    graph with onnxruntime rather than the torch model, which the exporter can't handle'''
+    torch.onnx.export(
+        LogitsOnly(model).eval(),
+        example,
+        export_fp,
+        input_names=['input_ids', 'attention_mask'],
+        output_names=['logits'],
+        dynamic_axes={'input_ids':{0:'batch', 1:'sequence'}, 'attention_mask':{0:'batch', 1:'sequence'},
+                      'logits':{0:'batch'}},
+        opset_version=14
+    )
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        quantized_fp = os.path.splitext(export_fp)[0]+'_int8.onnx'
+        quantize_dynamic(export_fp, quantized_fp, weight_type=QuantType.QInt8)
+        export_fp = quantized_fp
+
+    return export_fp
+
+
+def prepare_model(args, example):
+    '''The model to score with: the fp32 model, optionally with its Linear layers dynamically quantized
+    to int8, and optionally traced with TorchScript or exported to and run with ONNX Runtime'''
+    model = load_model(args.state_fp, args.bert_model)
+    if args.export == 'onnx':
+        onnx_fp = export_onnx(model, example, args.export_fp or 'bert_model.onnx', args.quantize)
+        print('Exported to {}'.format(onnx_fp))
+        return OnnxModel(onnx_fp, args.threads)
+    if args.quantize:
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if args.export == 'torchscript':
+        model = export_torchscript(model, example, args.export_fp)
+        if args.export_fp is not None:
+            print('Exported to {}'.format(args.export_fp))
+
+    return model
+
+
+def iter_batches(loader, n_batches=None):
+    for i, batch in enumerate(loader):
+        if n_batches is not None and i == n_batches:
+            break
+        yield batch['input_ids'].long(), batch['attn_masks'].long(), batch
+
+
+def score(model, loader, n_batches=None):
+    '''
+    Runs the model over the batches of loader (all of them, or the first n_batches) without autograd and
+    returns the logits, labels and patient IDs of the sequences, and the latency of each batch in seconds
+    '''
+    logits, labels, patient_ids, latencies = [], [], [], []
+    with inference_mode():
+        for input_ids, attn_masks, batch in iter_batches(loader, n_batches):
+            start = perf_counter()
+            logits.append(_logits(model(input_ids, attn_masks)).float().numpy())
+            latencies.append(perf_counter()-start)
+            labels.append(batch['labels'].numpy())
+            patient_ids.append(batch['patient_ids'].numpy())
+
+    return np.concatenate(logits), np.concatenate(labels), np.concatenate(patient_ids), np.array(latencies)
+
+
+def benchmark(models, loader, n_batches):
+    '''Latency and throughput of each model over the same first n_batches batches, after one warm-up batch'''
+    n_tokens = sum(int(b['attn_masks'].sum()) for _, _, b in iter_batches(loader, n_batches))
+    n_seqs = sum(len(b['labels']) for _, _, b in iter_batches(loader, n_batches))
+    results, reference = {}, None
+    for name, model in models.items():
+        score(model, loader, 1)
+        logits, _, _, latencies = score(model, loader, n_batches)
+        total = latencies.sum()
+        results[name] = {
+            'batch_ms_mean':1000*latencies.mean(),
+            'batch_ms_p50':1000*np.percentile(latencies, 50),
+            'batch_ms_p95':1000*np.percentile(latencies, 95),
+            'seqs_per_sec':n_seqs/total,
+            'tokens_per_sec':n_tokens/total
+        }
+        # how far the optimised model's probabilities are from the fp32 model's
+        proba = torch.softmax(torch.as_tensor(logits), -1)[:, 1].numpy()
+        if reference is None:
+            reference = proba
+        results[name]['max_proba_diff'] = float(np.abs(proba-reference).max())
+
+    return DataFrame(results).T
+
+
+def main(args):
+    print('=========')
+    torch.set_num_threads(args.threads)
+    if args.interop_threads is not None:
+        torch.set_num_interop_threads(args.interop_threads)
+
+    print('Loading encoded notes...')
+    dataset = load_or_encode(
+        args.cache_dir, args.notes_fp, args.readm_fp, args.bert_model, args.txtvar, args.st_aug, args.sequence_len,
+        stride=args.chunk_stride, policy=args.chunk_policy, max_note_chunks=args.max_note_chunks,
+        max_patient_chunks=args.max_patient_chunks, workers=args.tokenize_workers, verbose=True
+    )
+    # batches of similar lengths with as little padding as possible, in a fixed order
+    loader = data.DataLoader(
+        dataset,
+        batch_sampler=BucketBatchSampler(data.SequentialSampler(dataset), dataset.lengths, args.batch, shuffle=False),
+        collate_fn=collate_dynamic
+    )
+    example = next(iter_batches(loader, 1))[:2]
+
+    print('Preparing model...')
+    model = prepare_model(args, example)
+
+    if args.benchmark:
+        print('Benchmarking on {} batches of {} sequences...'.format(args.benchmark_batches, args.batch))
+        models = {'fp32':load_model(args.state_fp, args.bert_model)}
+        if args.quantize or args.export != 'none':
+            models['int8' if args.quantize else 'optimised'] = model
+        results = benchmark(models, loader, args.benchmark_batches)
+        print(results.to_string(float_format='{:.4f}'.format))
+        if args.benchmark_fp is not None:
+            results.to_csv(args.benchmark_fp)
+
+    print('Scoring {} sequences...'.format(len(dataset)))
+    logits, labels, patient_ids, latencies = score(model, loader)
+    patient_logits, patient_labels, patients = aggregate_patient_logits(
+        logits, patient_ids, labels, pooling=args.logit_pooling, scale_factor=args.scale_factor
+    )
+    out = DataFrame({
+        'SUBJECT_ID':patients,
+        'READM_PROBA':torch.softmax(torch.as_tensor(patient_logits), -1)[:, 1].numpy()
+    })
+    if (patient_labels >= 0).all():
+        out['READM'] = patient_labels
+    out.to_csv(args.out_fp, index=False)
+    print('{} patients scored in {:.1f}s, written to {}'.format(len(out), latencies.sum(), args.out_fp))
+    print('=========')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''Scores patients on CPU with a BERT model trained by
+        bert_main.py, writing the readmission probability of each patient''')
+    parser.add_argument('notes_fp', type=str)
+    parser.add_argument('readm_fp', type=str, help='''patients to score (SUBJECT_ID index), with their READM labels
+        if they are known''')
+    parser.add_argument('state_fp', type=str, help='.pt file of the model weights saved by bert_main.py')
+    parser.add_argument('bert_model', type=str, help='name or path of the BERT model that was fine-tuned')
+    parser.add_argument('txtvar', type=str)
+    parser.add_argument('--st_aug', action='store_true')
+    parser.add_argument('--out_fp', type=str, default='patient_readmission_probabilities.csv')
+    parser.add_argument('--sequence_len', type=int, default=256)
+    parser.add_argument('--chunk_stride', type=int, default=0)
+    parser.add_argument('--chunk_policy', type=str, default='all', choices=POLICIES)
+    parser.add_argument('--max_note_chunks', type=int, default=None)
+    parser.add_argument('--max_patient_chunks', type=int, default=None)
+    parser.add_argument('--logit_pooling', type=str, default='scaled', choices=list(LOGIT_POOLINGS))
+    parser.add_argument('--scale_factor', type=float, default=2.0)
+    parser.add_argument('--cache_dir', type=str, default='bert_encodings')
+    parser.add_argument('--tokenize_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--batch', type=int, default=64)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads(),
+        help='intra-op threads, best set to the number of physical cores')
+    parser.add_argument('--interop_threads', type=int, default=None)
+    parser.add_argument('--quantize', action='store_true', help='dynamically quantize the Linear layers to int8')
+    parser.add_argument('--export', type=str, default='none', choices=['none', 'torchscript', 'onnx'],
+        help='trace the model with TorchScript, or export it to ONNX and score with ONNX Runtime')
+    parser.add_argument('--export_fp', type=str, default=None, help='where to save the exported model')
+    parser.add_argument('--benchmark', action='store_true',
+        help='compare the latency and throughput of the chosen model with the fp32 model before scoring')
+    parser.add_argument('--benchmark_batches', type=int, default=20)
+    parser.add_argument('--benchmark_fp', type=str, default=None, help='.csv file for the benchmark results')
+
+    main(parser.parse_args())
@@ -1,5 +1,5 @@
 import argparse
-from lib import MIMICBERTReadmissionPredictor
+from lib import MIMICBERTReadmissionPredictor, MIMICBERTPatientPredictor
 from pytorch_lightning import Trainer
 from pytorch_lightning.loggers import TensorBoardLogger
 from torch import cuda, save
@@ -17,7 +17,9 @@ def run(txtvar, st_aug, data_dir, logdir, n_gpus):
     print('=========')
     print(msg1)
     s = time()
-    model = MIMICBERTReadmissionPredictor(
+    # the patient-level model takes the same arguments, plus its own
+    predictor = MIMICBERTPatientPredictor if args.patient_level else MIMICBERTReadmissionPredictor
+    model = predictor(
         n_train_fp=os.path.join(data_dir, 'notes_train_seeded.csv'),
         r_train_fp=os.path.join(data_dir, 'readmission_train_seeded.csv'),
         n_test_fp=os.path.join(data_dir, 'notes_test_seeded.csv'),
@@ -25,16 +27,41 @@ def run(txtvar, st_aug, data_dir, logdir, n_gpus):
         epochs=4,
         val_frac=0.2,
         batch_size=args.batch,
-        lr=0.01,
-        momentum=0.5,
+        lr=args.lr,
+        momentum=args.momentum,
         bert_model=args.bert_model,
         txtvar=txtvar,
         seqlen=512,
         st_aug=st_aug,
         db=args.debug,
         write_test_results_to=os.path.join(logdir, test_outpath),
-        verbose=args.verbose
+        verbose=args.verbose,
+        cache_dir=args.cache_dir,
+        tokenize_workers=args.tokenize_workers,
+        bucket_batches=not args.no_bucketing,
+        logit_pooling=args.logit_pooling,
+        chunk_stride=args.chunk_stride,
+        chunk_policy=args.chunk_policy,
+        max_note_chunks=args.max_note_chunks,
+        max_patient_chunks=args.max_patient_chunks,
+        patient_chunks=args.patient_chunks,
+        freeze_bert=not args.finetune_bert,
+        feature_cache_dir=args.feature_cache_dir,
+        head_dropout=args.head_dropout,
+        frozen_layers=args.frozen_layers,
+        train_sampling=args.train_sampling,
+        epoch_fraction=args.epoch_fraction,
+        neg_ratio=args.neg_ratio,
+        weighted_loss=args.weighted_loss,
+        loader_workers=args.loader_workers if args.loader_workers == 'auto' else int(args.loader_workers),
+        prefetch_factor=args.prefetch_factor,
+        persistent_workers=not args.no_persistent_workers,
+        pin_memory=cuda.is_available() and not args.no_pin_memory
     )
+    if int(os.environ.get('LOCAL_RANK', 0)) == 0:
+        # the notes are encoded (and the frozen outputs cached) here, before the trainer starts the other DDP
+        # processes, which then only load the caches rather than wait for them at a barrier that would time out
+        model.prepare_data()
     trainer = Trainer(
         default_root_dir=logdir,
         gpus=(n_gpus if cuda.is_available() else 0),
@@ -42,6 +69,8 @@ def run(txtvar, st_aug, data_dir, logdir, n_gpus):
         logger=(TensorBoardLogger(logdir, name='tb') if args.log else None),
         fast_dev_run=args.debug,
         distributed_backend='ddp',
+        # the model makes its own distributed samplers, see MIMICBERTReadmissionPredictor._dataloader
+        replace_sampler_ddp=False,
         accumulate_grad_batches=args.grad_accum
     )
     print('GPUs used;')
@@ -93,10 +122,57 @@ if __name__ == '__main__':
     parser.add_argument('--epochs', type=int, default=4)
     parser.add_argument('--batch', type=int, default=64)
     parser.add_argument('--grad_accum', type=int, default=1)
+    parser.add_argument('--lr', type=float, default=0.01)
+    parser.add_argument('--momentum', type=float, default=0.5)
     parser.add_argument('--gpus', type=int, default=-1)
     parser.add_argument('--log', action='store_true')
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--cache_dir', type=str, default=None,
+        help='directory for the tokenized notes, by default a bert_encodings directory next to the notes files')
+    parser.add_argument('--tokenize_workers', type=int, default=os.cpu_count(),
+        help='number of processes used to tokenize the notes the first time they are encoded')
+    parser.add_argument('--logit_pooling', type=str, default='scaled', choices=['scaled', 'mean', 'max'],
+        help='how the test logits of the sequences of a patient are combined into one prediction')
+    parser.add_argument('--loader_workers', type=str, default='auto',
+        help='''number of DataLoader worker processes, or auto to time a few settings on the training set and
+        take the fewest workers that load batches about as fast as the most''')
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='batches loaded ahead by each loader worker')
+    parser.add_argument('--no_persistent_workers', action='store_true',
+        help='start new loader workers every epoch rather than keeping them')
+    parser.add_argument('--no_pin_memory', action='store_true', help="don't pin batches in memory for the GPU copy")
+    parser.add_argument('--no_bucketing', action='store_true',
+        help='batch sequences in random order rather than grouping sequences of similar lengths')
+    parser.add_argument('--chunk_stride', type=int, default=0,
+        help='number of tokens shared by consecutive chunks of a note longer than the sequence length')
+    parser.add_argument('--chunk_policy', type=str, default='all', choices=['head', 'tail', 'head+tail', 'all'],
+        help='which chunks of each note are kept')
+    parser.add_argument('--max_note_chunks', type=int, default=None, help='maximum number of chunks kept per note')
+    parser.add_argument('--max_patient_chunks', type=int, default=None,
+        help='maximum number of chunks kept per patient (the last ones)')
+    parser.add_argument('--train_sampling', type=str, default='random', choices=['random', 'weighted', 'subsample'],
+        help='''how training sequences are drawn each epoch: all of them in random order, with replacement with
+        balanced weights per patient, or all positive patients with a random subsample of the negative ones''')
+    parser.add_argument('--epoch_fraction', type=float, default=1.0,
+        help='with weighted sampling, sequences drawn per epoch as a fraction of the training set')
+    parser.add_argument('--neg_ratio', type=float, default=1.0,
+        help='with subsampling, negative patients kept per positive patient each epoch')
+    parser.add_argument('--weighted_loss', action='store_true',
+        help='weight the training loss by the inverse frequency of each class of patients (instead of resampling)')
+    parser.add_argument('--patient_level', action='store_true',
+        help='''train on patients rather than sequences, pooling the [CLS] embeddings of the sequences of each
+        patient with attention (--batch is then the number of patients per batch)''')
+    parser.add_argument('--patient_chunks', type=int, default=32,
+        help='maximum number of sequences per patient in the patient-level model (the last ones)')
+    parser.add_argument('--finetune_bert', action='store_true',
+        help='''train BERT through the patient-level head, rather than training the head alone on embeddings
+        of the pre-trained model that are computed once and cached''')
+    parser.add_argument('--feature_cache_dir', type=str, default=None,
+        help='directory for the cached BERT outputs, by default the directory of the encoded sequences')
+    parser.add_argument('--head_dropout', type=float, default=0.1)
+    parser.add_argument('--frozen_layers', type=int, default=None,
+        help='''freeze the embeddings and this many encoder layers, whose outputs are computed once and cached
+        (as float16, in --feature_cache_dir) so that training only runs the layers above them''')
     global args
     args = parser.parse_args()
 
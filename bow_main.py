@@ -1,51 +1,104 @@
+import os
+import json
+import shutil
 import pandas as pd
 import argparse
 from warnings import simplefilter
-from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
-from sklearn.model_selection import GridSearchCV, StratifiedKFold
+from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer, HashingVectorizer
+from sklearn.preprocessing import normalize
+from sklearn.model_selection import StratifiedKFold, ParameterGrid
 from sklearn.linear_model import SGDClassifier
 from sklearn.metrics import precision_score, recall_score, f1_score, roc_auc_score
-from scipy.sparse import vstack
-from joblib import dump
-from collections import defaultdict
-from tqdm import tqdm
-from numpy import asarray, mean
-from util import load_txt_df
+from scipy.sparse import csr_matrix, coo_matrix, diags, save_npz, load_npz
+from joblib import dump, Parallel, delayed
+from time import process_time
+from numpy import asarray, mean, unique, argsort, searchsorted, ones, zeros, flatnonzero, bincount, int64, r_,\
+    maximum, log, save, arange, concatenate
+from util import load_txt_df, iter_txt_df, file_fingerprint, cache_key, timed, cpu_seconds, stratified_subsample,\
+    halving_budgets, successive_halving
 
 
-def aggregate_embeddings(id_vector, tfidf_matrix):
-    # I wasn't sure how pandas groupby+add would deal with scipy.sparse.csc
-    # matrices so I just added them into a dictionary...
+def patient_codes(id_vector, patients=None):
+    '''
+    Maps each note's patient ID to a row of the patient-level matrix; if patients is given
+    the rows follow its order (e.g. the index of the readmission labels) and notes of patients
+    not in it are given the code -1, otherwise the rows are the sorted unique patient IDs
+    '''
+    if patients is None:
+        patients, codes = unique(id_vector, return_inverse=True)
+        return patients, codes
+    patients = asarray(patients)
+    sorter = argsort(patients, kind='mergesort')
+    pos = searchsorted(patients, id_vector, sorter=sorter).clip(0, max(len(patients)-1, 0))
+    codes = sorter[pos]
+    codes[patients[codes] != id_vector] = -1
+
+    return patients, codes
+
+
+def aggregate_embeddings(id_vector, tfidf_matrix, patients=None, pooling='sum'):
+    '''
+    Pools the rows of the note-level sparse matrix into one row per patient with a
+    patient-indicator matrix product, so the matrix is never densified. Mean pooling
+    divides the sums by the number of notes of each patient; max pooling works on the
+    stored entries only, which is exact for non-negative features like TF-IDF weights.
+    '''
     assert(len(id_vector) == tfidf_matrix.shape[0])
-    tfidf_map = defaultdict()
-    for patient, vector in tqdm(zip(id_vector, tfidf_matrix), total=len(id_vector)):
-        tfidf_map[patient] += vector
+    patients, codes = patient_codes(asarray(id_vector), patients)
+    keep = codes >= 0
+    n_patients, n_features = len(patients), tfidf_matrix.shape[1]
+    indicator = csr_matrix(
+        (ones(keep.sum()), (codes[keep], flatnonzero(keep))),
+        shape=(n_patients, len(codes))
+    )
 
-    # ... and then stacked the dictionary values back to a matrix
-    print('stacking matrix...')
-    X = tfidf_map.popitem(False)[1]
-    for x in tqdm(tfidf_map.values()):
-        X = vstack((X, x))
+    if pooling in ['sum', 'mean']:
+        X = (indicator @ tfidf_matrix).tocsr()
+        if pooling == 'mean':
+            counts = bincount(codes[keep], minlength=n_patients)
+            X = diags(1/counts.clip(1)) @ X
+    elif pooling == 'max':
+        # CSR group-by-max: sort the stored entries by (patient, feature) and take the
+        # maximum of each run
+        coo = tfidf_matrix.tocoo()
+        rows = codes[coo.row]
+        in_patients = rows >= 0
+        X = group_max(rows[in_patients], coo.col[in_patients], coo.data[in_patients], (n_patients, n_features))
+    else:
+        raise NameError('invalid string passed to pooling argument')
 
     return X
 
 
-def main(args):
-    print('=======================')
+def group_max(rows, cols, data, shape):
+    '''CSR matrix of the given shape holding the maximum of the entries at each (row, column) pair'''
+    n_features = shape[1]
+    keys = asarray(rows).astype(int64)*n_features+cols
+    order = argsort(keys, kind='mergesort')
+    keys, data = keys[order], asarray(data)[order]
+    if len(keys) == 0:
+        return csr_matrix(shape)
+    starts = flatnonzero(r_[True, keys[1:] != keys[:-1]])
 
-    print('Loading data...')
+    return csr_matrix((maximum.reduceat(data, starts), (keys[starts]//n_features, keys[starts] % n_features)), shape=shape)
+
+
+def split_analyzer(note):
+    return note.split(' ')
+
+
+def in_memory_tfidf(args, readm_train, readm_test):
+    '''Fits the vocabulary and TF-IDF weights on the train and test notes together, all in memory'''
     notes_train = load_txt_df(
         fp=args.n_train,
         var=args.var,
         st_aug=args.st_aug
     )
-    readm_train = pd.read_csv(args.r_train, index_col=0)
     notes_test = load_txt_df(
         fp=args.n_test,
         var=args.var,
         st_aug=args.st_aug
     )
-    readm_test = pd.read_csv(args.r_test, index_col=0)
 
     if args.st_aug:
         print('Adding semantic types to '+args.var)
@@ -61,57 +114,226 @@ def main(args):
 
     # compute bag-of-words embeddings
     print('Calculating BoW Matrix...')
-    bow_matrix = CountVectorizer(analyzer=lambda s: s.split(' '))\
-        .fit(all_notes[args.var]).transform(all_notes[args.var])
+    vectorizer = CountVectorizer(analyzer=split_analyzer).fit(all_notes[args.var])
+    bow_matrix = vectorizer.transform(all_notes[args.var])
 
     # normalisation via term frequency-inverse document frequency
     print('TF-IDF...')
-    tfidf_matrix = TfidfTransformer().fit(bow_matrix).transform(bow_matrix)
+    transformer = TfidfTransformer().fit(bow_matrix)
+    tfidf_matrix = transformer.transform(bow_matrix)
 
-    print('aggregating training set embeddings...')
+    print('aggregating embeddings...')
+    # patient rows follow the order of the label files
     X_train = aggregate_embeddings(
         notes_train.SUBJECT_ID.values,
-        tfidf_matrix[:len(notes_train)]
+        tfidf_matrix[:len(notes_train)],
+        patients=readm_train.index.values,
+        pooling=args.pooling
+    )
+    X_test = aggregate_embeddings(
+        notes_test.SUBJECT_ID.values,
+        tfidf_matrix[len(notes_train):],
+        patients=readm_test.index.values,
+        pooling=args.pooling
+    )
+    vocabulary = dict((term, int(i)) for term, i in vectorizer.vocabulary_.items())
+
+    return X_train, X_test, transformer.idf_, vocabulary
+
+
+def streaming_tfidf(args, readm_train, readm_test):
+    '''
+    Out-of-core version of in_memory_tfidf: the notes are read in chunks and hashed into a
+    fixed number of features, so there is no vocabulary to hold in memory. A first pass over
+    the training notes counts document frequencies (the IDF weights are fit on the training
+    set only), then each chunk of TF-IDF vectors is pooled into the patient-level matrix as
+    soon as it is computed, so only one chunk of notes is ever held at a time.
+    '''
+    vectorizer = HashingVectorizer(
+        analyzer=split_analyzer,
+        n_features=args.n_features,
+        alternate_sign=False,
+        norm=None
+    )
+
+    def _chunks(fp):
+        for chunk in iter_txt_df(fp, args.var, args.st_aug, args.chunksize):
+            if args.st_aug:
+                chunk = augment_var(chunk, args.var)
+            yield chunk.SUBJECT_ID.values, vectorizer.transform(chunk[args.var])
+
+    print('Counting document frequencies...')
+    doc_freq = zeros(args.n_features)
+    n_docs = 0
+    for _, counts in _chunks(args.n_train):
+        doc_freq += bincount(counts.indices, minlength=args.n_features)
+        n_docs += counts.shape[0]
+    # same smoothed IDF as TfidfTransformer
+    idf_weights = log((1+n_docs)/(1+doc_freq))+1
+    idf = diags(idf_weights)
+
+    def _patient_matrix(fp, patients):
+        shape = (len(patients), args.n_features)
+        # entries of each chunk's pooled matrix, combined once at the end rather than chunk by chunk
+        rows, cols, data = [], [], []
+        n_notes = zeros(len(patients))
+        for ids, counts in _chunks(fp):
+            tfidf = normalize(counts @ idf)
+            part = aggregate_embeddings(
+                ids, tfidf, patients=patients, pooling='max' if args.pooling == 'max' else 'sum'
+            ).tocoo()
+            rows.append(part.row)
+            cols.append(part.col)
+            data.append(part.data)
+            codes = patient_codes(ids, patients)[1]
+            n_notes += bincount(codes[codes >= 0], minlength=len(patients))
+        if not data:
+            return csr_matrix(shape)
+        rows, cols, data = concatenate(rows), concatenate(cols), concatenate(data)
+        if args.pooling == 'max':
+            return group_max(rows, cols, data, shape)
+        # duplicate entries are summed
+        X = coo_matrix((data, (rows, cols)), shape=shape).tocsr()
+        if args.pooling == 'mean':
+            X = diags(1/n_notes.clip(1)) @ X
+
+        return X.tocsr()
+
+    print('Streaming training set TF-IDF...')
+    X_train = _patient_matrix(args.n_train, readm_train.index.values)
+    print('Streaming test set TF-IDF...')
+    X_test = _patient_matrix(args.n_test, readm_test.index.values)
+
+    # hashed features have no vocabulary
+    return X_train, X_test, idf_weights, None
+
+
+def _feature_cache_dir(args):
+    '''Cache directory for the patient-level matrices of this combination of inputs and vectoriser settings'''
+    key = cache_key(
+        inputs=[file_fingerprint(fp) for fp in [args.n_train, args.n_test, args.r_train, args.r_test]],
+        var=args.var,
+        st_aug=args.st_aug,
+        pooling=args.pooling,
+        vectorizer='hashing' if args.streaming else 'count',
+        n_features=args.n_features if args.streaming else None
     )
 
-    # cross-validation grid search for the best-scoring model
+    return os.path.join(args.cache_dir, 'bow_'+key)
+
+
+def save_features(cache_dir, X_train, X_test, idf, vocabulary, meta):
+    # written to a temporary directory first so that an interrupted write isn't mistaken for a cache hit
+    tmp_dir = cache_dir+'.tmp'
+    os.makedirs(tmp_dir, exist_ok=True)
+    save_npz(os.path.join(tmp_dir, 'X_train.npz'), X_train)
+    save_npz(os.path.join(tmp_dir, 'X_test.npz'), X_test)
+    save(os.path.join(tmp_dir, 'idf.npy'), idf)
+    if vocabulary is not None:
+        with open(os.path.join(tmp_dir, 'vocabulary.json'), 'w+') as f:
+            json.dump(vocabulary, f)
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w+') as f:
+        json.dump(meta, f, indent=1)
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_dir, cache_dir)
+
+
+def load_features(cache_dir):
+    return load_npz(os.path.join(cache_dir, 'X_train.npz')), load_npz(os.path.join(cache_dir, 'X_test.npz'))
+
+
+def _fold_auroc(X, y, params, train_idx, val_idx, seed):
+    clf = SGDClassifier(random_state=seed, **params).fit(X[train_idx], y[train_idx])
+    return roc_auc_score(y[val_idx], clf.decision_function(X[val_idx]))
+
+
+def search_sgd(X, y, param_grid, budgets, eta=3, tol=None, seed=1, n_jobs=-1):
+    '''
+    Cross-validated search for the SGD classifier parameters by AUROC, run as successive halving
+    over stratified subsamples of the patients (budgets are fractions of the training set) - a
+    single budget of 1 is an exhaustive grid search. Returns the best parameters, their mean AUROC
+    and the CPU-seconds spent.
+    '''
+    configs = list(ParameterGrid(param_grid))
+    cv = StratifiedKFold(n_splits=5, shuffle=True, random_state=seed)
+    start, timings = process_time(), []
+
+    def evaluate(params_list, budget):
+        rows = arange(len(y)) if budget >= 1 else stratified_subsample(y, budget, seed)
+        folds = [(rows[train_idx], rows[val_idx]) for train_idx, val_idx in cv.split(rows, y[rows])]
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(timed)(_fold_auroc, X, y, params, train_idx, val_idx, seed)
+            for params in params_list for train_idx, val_idx in folds
+        )
+        timings.extend((t, pid) for _, t, pid in results)
+        return asarray([r[0] for r in results]).reshape((len(params_list), len(folds))).mean(1)
+
+    best_params, best_score, _ = successive_halving(configs, evaluate, budgets, eta=eta, tol=tol)
+
+    return best_params, best_score, cpu_seconds(start, timings)
+
+
+def main(args):
+    print('=======================')
+
+    print('Loading data...')
+    readm_train = pd.read_csv(args.r_train, index_col=0)
+    readm_test = pd.read_csv(args.r_test, index_col=0)
+    cache_dir = None if args.cache_dir is None else _feature_cache_dir(args)
+    if cache_dir is not None and os.path.exists(os.path.join(cache_dir, 'meta.json')):
+        print('Loading cached features from {}...'.format(cache_dir))
+        X_train, X_test = load_features(cache_dir)
+    else:
+        if args.streaming:
+            X_train, X_test, idf, vocabulary = streaming_tfidf(args, readm_train, readm_test)
+        else:
+            X_train, X_test, idf, vocabulary = in_memory_tfidf(args, readm_train, readm_test)
+        if cache_dir is not None:
+            print('Caching features in {}...'.format(cache_dir))
+            save_features(cache_dir, X_train, X_test, idf, vocabulary, meta={
+                'n_train':os.path.abspath(args.n_train),
+                'n_test':os.path.abspath(args.n_test),
+                'var':args.var,
+                'st_aug':args.st_aug,
+                'pooling':args.pooling,
+                'streaming':args.streaming,
+                'n_features':X_train.shape[1]
+            })
+
+    # cross-validation search for the best-scoring model
     print('Testing different SVM models...\n')
-    grid_sgd = GridSearchCV(
-        SGDClassifier(random_state=args.seed),
-        param_grid=[
-            {
-                'alpha':[10**i for i in range(-4, 1)],
-                'penalty':['l2', 'elasticnet']
-            }
-        ],
-        refit=True,
-        n_jobs=-1,
-        scoring='roc_auc',
-        cv=StratifiedKFold(n_splits=5, shuffle=True, random_state=args.seed)
+    budgets = halving_budgets(args.eta, args.rungs) if args.search == 'halving' else [1.0]
+    best_params, best_score, cpu_time = search_sgd(
+        X_train,
+        readm_train.READM.values,
+        param_grid={
+            'alpha':[10**i for i in range(-4, 1)],
+            'penalty':['l2', 'elasticnet']
+        },
+        budgets=budgets,
+        eta=args.eta,
+        tol=args.search_tol,
+        seed=args.seed
     )
-    gridsearch_res = grid_sgd.fit(X_train, readm_train.READM.values)
+    print('Search took {:.1f} CPU-seconds'.format(cpu_time))
+    model = SGDClassifier(random_state=args.seed, **best_params).fit(X_train, readm_train.READM.values)
 
     # write out details of the most optimal model
     details = '''SVM classification with SGD on BoW embeddings of MIMIC-III {} variable
 Best estimator\n{}\nArea under ROC: {:.3f}'''\
-        .format(args.var, gridsearch_res.estimator, gridsearch_res.best_score_)
+        .format(args.var, model, best_score)
     print('-- Training results --')
     print(details)
 
     # pickle the model
     if args.save_model:
-        dump(gridsearch_res, args.out_fp[:args.out_fp.rindex('.')+1]+'joblib')
-
-    print('aggregating test set embeddings...')
-    X_test = aggregate_embeddings(
-        notes_test.SUBJECT_ID.values,
-        tfidf_matrix[len(notes_train):]
-    )
+        dump(model, args.out_fp[:args.out_fp.rindex('.')+1]+'joblib')
 
     # make predictions
     print('Running chosen SVM model on test set...')
-    test_pred = gridsearch_res.predict(X_test)
-    test_score = gridsearch_res.decision_function(X_test)
+    test_pred = model.predict(X_test)
+    test_score = model.decision_function(X_test)
     true_labels = readm_test.READM.values
     test_acc = mean(asarray((test_pred == true_labels), dtype=int))
     test_prec = precision_score(true_labels, test_pred)
@@ -146,6 +368,26 @@ if __name__ == '__main__':
     parser.add_argument('--st_aug', action='store_true')
     parser.add_argument('--out_fp', type=str,
         default='~/data/mimic_experiment_writes/bowsgdresults.txt')
+    parser.add_argument('--pooling', type=str, default='sum', choices=['sum', 'mean', 'max'],
+        help='how note-level TF-IDF vectors are pooled for each patient')
+    parser.add_argument('--streaming', action='store_true',
+        help='hash the notes chunk by chunk instead of building the whole count matrix in memory')
+    parser.add_argument('--chunksize', type=int, default=10000,
+        help='number of notes per chunk in streaming mode')
+    parser.add_argument('--n_features', type=int, default=2**20,
+        help='number of hashed features in streaming mode')
+    parser.add_argument('--cache_dir', type=str, default=None,
+        help='''directory in which to cache the patient-level feature matrices - reruns on the same inputs with
+        the same vectoriser settings load them instead of recomputing them''')
+    parser.add_argument('--search', type=str, default='grid', choices=['grid', 'halving'],
+        help='''exhaustive grid search on the whole training set, or successive halving that scores every model
+        on a small subsample of the patients and only carries the best 1/eta on to larger ones''')
+    parser.add_argument('--eta', type=int, default=3,
+        help='fraction of models kept, and growth of the subsample, at each round of successive halving')
+    parser.add_argument('--rungs', type=int, default=3,
+        help='number of rounds of successive halving, the first on 1/eta^(rungs-1) of the patients')
+    parser.add_argument('--search_tol', type=float, default=None,
+        help='stop successive halving early once the best AUROC improves by less than this between rounds')
     parser.add_argument('--seed', type=int, default=1)
     parser.add_argument('--save_model', action='store_true')
 
@@ -0,0 +1,154 @@
+import os
+import json
+import argparse
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pandas import read_csv
+
+
+# columns kept in the store - TEXT/TERM/CUI/SEMTYPES are stored separately so that
+# a loader only has to read the one it needs
+ID_COLS = ['SUBJECT_ID', 'HADM_ID']
+TEXT_COLS = ['TEXT', 'TERM', 'CUI', 'SEMTYPES']
+META_FILE = '_store.json'
+
+
+def store_path(csv_fp):
+    '''Default location of the store made from a notes .csv file'''
+    return os.path.splitext(csv_fp)[0]+'.parquet'
+
+
+def is_store(fp):
+    return os.path.isdir(fp) and os.path.exists(os.path.join(fp, META_FILE))
+
+
+def _bucket_fp(store_fp, bucket):
+    return os.path.join(store_fp, 'bucket_{:03d}.parquet'.format(bucket))
+
+
+def _read_meta(store_fp):
+    with open(os.path.join(store_fp, META_FILE), 'r') as f:
+        return json.load(f)
+
+
+def convert(csv_fp, store_fp=None, n_buckets=16, chunksize=50000):
+    '''
+    Streams a notes .csv file into a directory of parquet files, one per SUBJECT_ID bucket
+    (SUBJECT_ID modulo n_buckets) so that loading a subset of patients only touches the
+    buckets they fall into. Within a bucket the notes keep their order in the .csv file and
+    each write is a separate row group, whose SUBJECT_ID statistics let pyarrow skip it.
+    '''
+    if store_fp is None:
+        store_fp = store_path(csv_fp)
+    header = read_csv(csv_fp, nrows=0).columns
+    text_cols = [c for c in TEXT_COLS if c in header]
+    dtypes = {'SUBJECT_ID':int}
+    for c in ['HADM_ID']+text_cols:
+        dtypes[c] = str
+    schema = pa.schema(
+        [('SUBJECT_ID', pa.int64())]+[(c, pa.string()) for c in ['HADM_ID']+text_cols]
+    )
+
+    os.makedirs(store_fp, exist_ok=True)
+    writers = {}
+    n_notes = 0
+    for chunk in read_csv(csv_fp, usecols=ID_COLS+text_cols, dtype=dtypes, chunksize=chunksize):
+        chunk = chunk[ID_COLS+text_cols]
+        buckets = chunk.SUBJECT_ID.values % n_buckets
+        for b in set(buckets.tolist()):
+            if b not in writers:
+                writers[b] = pq.ParquetWriter(_bucket_fp(store_fp, b), schema)
+            writers[b].write_table(
+                pa.Table.from_pandas(chunk[buckets == b], schema=schema, preserve_index=False)
+            )
+        n_notes += len(chunk)
+    for writer in writers.values():
+        writer.close()
+
+    # the metadata file is written last so that a half-converted directory isn't taken for a store
+    # (the underscore prefix stops pyarrow from treating it as a data file)
+    with open(os.path.join(store_fp, META_FILE), 'w+') as f:
+        json.dump({'source':os.path.abspath(csv_fp), 'n_buckets':n_buckets, 'columns':text_cols, 'n_notes':n_notes}, f)
+
+    return store_fp
+
+
+def load_columns(store_fp, columns, subject_ids=None, nrows=None):
+    '''
+    Reads the given columns of a store into a DataFrame along with SUBJECT_ID and HADM_ID, optionally
+    only for the notes of the patients in subject_ids. The notes are grouped by bucket, so they don't
+    come back in the order of the original .csv file.
+    '''
+    meta = _read_meta(store_fp)
+    n_buckets = meta['n_buckets']
+    columns = ID_COLS+[c for c in columns if c not in ID_COLS]
+    buckets, filters = _buckets_and_filters(n_buckets, subject_ids)
+
+    tables, n = [], 0
+    for b in buckets:
+        fp = _bucket_fp(store_fp, b)
+        if not os.path.exists(fp):
+            continue
+        tables.append(pq.read_table(fp, columns=columns, filters=filters))
+        n += tables[-1].num_rows
+        if nrows is not None and n >= nrows:
+            break
+    if len(tables) == 0:
+        table = pa.schema(
+            [('SUBJECT_ID', pa.int64())]+[(c, pa.string()) for c in columns[1:]]
+        ).empty_table()
+    else:
+        table = pa.concat_tables(tables)
+    if nrows is not None:
+        table = table.slice(0, nrows)
+
+    return table.to_pandas()
+
+
+def _buckets_and_filters(n_buckets, subject_ids):
+    # buckets holding the patients in subject_ids and the row filter pyarrow pushes down to the row groups
+    if subject_ids is None:
+        return range(n_buckets), None
+    subject_ids = [int(i) for i in subject_ids]
+    return sorted(set(i % n_buckets for i in subject_ids)), [('SUBJECT_ID', 'in', subject_ids)]
+
+
+def iter_columns(store_fp, columns, chunksize, subject_ids=None):
+    '''Yields the given columns of a store as DataFrames of at most chunksize notes, optionally only
+    for the notes of the patients in subject_ids'''
+    columns = ID_COLS+[c for c in columns if c not in ID_COLS]
+    buckets, filters = _buckets_and_filters(_read_meta(store_fp)['n_buckets'], subject_ids)
+    for b in buckets:
+        fp = _bucket_fp(store_fp, b)
+        if not os.path.exists(fp):
+            continue
+        if filters is None:
+            batches = pq.ParquetFile(fp).iter_batches(batch_size=chunksize, columns=columns)
+        else:
+            # only the row groups that can hold the patients are read
+            batches = pq.read_table(fp, columns=columns, filters=filters).to_batches(max_chunksize=chunksize)
+        for batch in batches:
+            yield batch.to_pandas()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''Converts notes .csv files into columnar stores that
+        can be passed to the training scripts in place of the .csv files''')
+    parser.add_argument('csv_fps', type=str, nargs='+')
+    parser.add_argument('-o', dest='store_fps', type=str, nargs='+', default=None, help='''output directories,
+        by default the .csv paths with a .parquet extension''')
+    parser.add_argument('--buckets', type=int, default=16)
+    parser.add_argument('--chunksize', type=int, default=50000)
+    args = parser.parse_args()
+
+    if args.store_fps is not None and len(args.store_fps) != len(args.csv_fps):
+        raise ValueError('-o needs one output directory for each .csv file')
+    for i, csv_fp in enumerate(args.csv_fps):
+        print('Converting {}...'.format(csv_fp))
+        out = convert(
+            csv_fp,
+            store_fp=None if args.store_fps is None else args.store_fps[i],
+            n_buckets=args.buckets,
+            chunksize=args.chunksize
+        )
+        print('Written to {}'.format(out))
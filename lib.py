@@ -1,3 +1,4 @@
+import os
 import torch
 import torch.utils.data as data
 from torch.optim import SGD
@@ -6,18 +7,26 @@ from torch.nn import CrossEntropyLoss
 import numpy as np
 import pytorch_lightning as pl
 import pytorch_lightning.metrics.classification as M
-from pandas import DataFrame, read_csv, isna
+from pandas import DataFrame, read_csv, factorize
 from nltk import word_tokenize
 from collections import OrderedDict
+from itertools import chain, repeat
 from gensim.models import Word2Vec
-from sklearn.pipeline import Pipeline
-from sklearn.model_selection import GridSearchCV, StratifiedKFold
+from sklearn.model_selection import GridSearchCV, StratifiedKFold, ParameterGrid
 from sklearn.linear_model import SGDClassifier
 from sklearn.metrics import precision_score, recall_score, f1_score, roc_auc_score
-from transformers import BertTokenizer, BertForSequenceClassification, AdamW
-from math import ceil
+from transformers import BertForSequenceClassification, AdamW
 from random import sample
-from util import load_txt_df
+from scipy.sparse import csr_matrix
+from joblib import Parallel, delayed
+from time import process_time, perf_counter
+from multiprocessing import cpu_count
+from token_cache import TokenizedCorpus
+from bert_encoding import load_or_encode, collate_dynamic, collate_patients, BucketBatchSampler, PatientDataset,\
+    PatientSampler, loader_kwargs, probe_loader
+from patient_pooling import aggregate_patient_logits
+from bert_features import load_or_embed, run_layers, CachedDataset
+from util import iter_txt_df, timed, cpu_seconds, stratified_subsample, halving_budgets, successive_halving
 from pkg_resources import parse_version
 
 
@@ -25,12 +34,50 @@ from pkg_resources import parse_version
 # WORD2VEC IMPLEMENTATION CLASSES #
 ###################################
 
+def note_lengths(text):
+    if isinstance(text, TokenizedCorpus):
+        return text.lengths()
+    return np.fromiter((len(note) for note in text), dtype=np.int64, count=len(text))
+
+
+def pool_rows(table, rows, lengths, block_rows=2**10):
+    '''
+    Mean, max and min (concatenated) of the rows of table picked by rows, for notes of the given numbers of
+    rows (rows holds those of one note after the other), with zeros for notes without rows. Notes are
+    gathered in blocks of notes of similar lengths, padded with their first row, and each block is reduced
+    in one go; the sums run over each note's rows in order, in the precision of table, and are divided as
+    np.mean does, so the result is the same as reducing every note on its own.
+    '''
+    dim = table.shape[1]
+    X = np.zeros((len(lengths), dim*3))
+    offsets = np.r_[0, np.cumsum(lengths)]
+    order = np.argsort(lengths, kind='mergesort')
+    order = order[lengths[order] > 0]
+    i = 0
+    while i < len(order):
+        # about block_rows gathered rows per block, so that they stay in cache while being reduced
+        block = order[i:i+max(1, block_rows//int(lengths[order[i]]))]
+        cols = np.arange(int(lengths[block[-1]]))[None, :]
+        in_note = cols < lengths[block][:, None]
+        # the padding, a repeat of a row of the same note, changes neither its max nor its min
+        vectors = table[rows[offsets[block][:, None]+np.where(in_note, cols, 0)]]
+        X[block, dim:2*dim] = vectors.max(1)
+        X[block, 2*dim:] = vectors.min(1)
+        vectors[~in_note] = 0
+        X[block, :dim] = (vectors.sum(1).astype(np.float64)/lengths[block][:, None]).astype(table.dtype)
+        i += len(block)
+
+    return X
+
+
 class W2VEmbedAggregate(object):
     '''Object that implements scikit-learn style methods to compute Word2Vec embeddings
     and aggregate across notes/patients'''
 
-    def __init__(self, patient_ids, **kwargs):
+    def __init__(self, patient_ids, subword=False, **kwargs):
         self.patient_ids = patient_ids
+        # train FastText instead, whose character n-gram vectors give vectors for out-of-vocabulary words
+        self.subword = subword
         self.arg_names = ['sg', 'size', 'window', 'min_count', 'alpha', 'iter', 'workers']
 
     def set_params(self, **kwargs):
@@ -40,34 +87,87 @@ class W2VEmbedAggregate(object):
         '''Trains a Word2Vec model: only to be called internally in the fit() method of the grid search'''
         w2v_kwargs = {}
         w2v_kwargs.update((k, v) for k, v in self.__dict__.items() if k in self.arg_names)
-        self.embedding = Word2Vec(text, **w2v_kwargs)
+        if self.subword:
+            from gensim.models import FastText
+
+            self.embedding = FastText(text, **w2v_kwargs)
+        else:
+            self.embedding = Word2Vec(text, **w2v_kwargs)
 
         return self
 
-    def transform(self, text, assign_to_attr=True):
-        '''Aggregates over all word embeddings in each note'''
+    def _vocab_indices(self, words):
+        '''Rows of the word vector matrix of a sequence of words, -1 for out-of-vocabulary words'''
+        word_vectors = self.embedding.wv
+        # gensim 4 keeps a key_to_index dictionary, earlier versions a dictionary of Vocab objects
+        if hasattr(word_vectors, 'key_to_index'):
+            lookup = word_vectors.key_to_index
+        else:
+            lookup = dict((w, v.index) for w, v in word_vectors.vocab.items())
+
+        return np.fromiter(map(lookup.get, words, repeat(-1)), dtype=np.int64, count=len(words))
+
+    def _word_table(self, words, word_rows):
+        '''Vectors of distinct words given their rows of the word vector matrix, with the out-of-vocabulary
+        words (rows -1) built from their subword vectors'''
+        word_vectors = self.embedding.wv
+        table = np.empty((len(words), word_vectors.vector_size), dtype=word_vectors.vectors.dtype)
+        oov = word_rows < 0
+        table[~oov] = word_vectors.vectors[word_rows[~oov]]
+        if oov.any():
+            table[oov] = np.array([word_vectors[w] for w in words[oov]]).reshape((int(oov.sum()), -1))
+
+        return table
+
+    def transform(self, text, assign_to_attr=True, batch_tokens=2**22):
+        '''
+        Aggregates over all word embeddings in each note (concatenation of the mean, max and
+        min). The tokens of a batch of notes are factorized into distinct words, which are mapped
+        to vocabulary indices once each, and pooled per note from the rows of the embedding matrix
+        with pool_rows (giving the same values as reducing each note on its own); batches hold about
+        batch_tokens tokens so that their indices don't have to fit in memory all at once.
+        The model isn't updated, so this can embed unseen notes: out-of-vocabulary words are
+        skipped, unless the model was trained with subword vectors.
+        '''
         word_vectors = self.embedding.wv
+        subword = getattr(self, 'subword', False)
         dim = word_vectors.vector_size
         n = len(text)
-
-        # aggregate the word vectors for each note (concatenation)
-        _concat_aggreg = lambda arr: np.concatenate(
-            (np.mean(arr, 0), np.max(arr, 0), np.min(arr, 0))
-        )
-        X = np.empty((n, dim*3))
-        for i in range(n):
-            note_list = []
-            for word in text[i]:
-                try:
-                    note_list.append(word_vectors[word])
-                except KeyError:
-                    continue
-            if len(note_list) == 0:
-                # even if no word vectors are found the output matrix still needs to be the right shape
-                X[i,:] = np.zeros(dim*3)
+        lengths = note_lengths(text)
+        offsets = np.r_[0, np.cumsum(lengths)]
+
+        # even if no word vectors are found for a note its row still needs to be there
+        X = np.zeros((n, dim*3))
+        if isinstance(text, TokenizedCorpus):
+            # the cache's vocabulary is mapped to word vector rows once, then token IDs are just array lookups
+            vocab_rows = self._vocab_indices(text.vocab)
+        start = 0
+        while start < n:
+            stop = max(int(np.searchsorted(offsets, offsets[start]+batch_tokens, side='right'))-1, start+1)
+            # notes are numbered from the start of the batch
+            note_of_token = np.repeat(np.arange(stop-start), lengths[start:stop])
+            # each token as a code of the distinct words of the batch, which are looked up once each
+            if isinstance(text, TokenizedCorpus):
+                token_ids = text.token_ids(start, stop)
+                if subword:
+                    word_ids, codes = np.unique(token_ids, return_inverse=True)
+                    words, word_rows = text.vocab[word_ids], vocab_rows[word_ids]
+            else:
+                codes, words = factorize(np.fromiter(
+                    chain.from_iterable(text[start:stop]), dtype=object, count=int(offsets[stop]-offsets[start])
+                ))
+                word_rows = self._vocab_indices(words)
+            if subword:
+                # every token has a vector, pooled from those of the distinct words of the batch
+                table, rows = self._word_table(np.asarray(words, dtype=object), word_rows), codes
             else:
-                note_array = np.array(note_list).reshape((len(note_list), dim))
-                X[i,:] = _concat_aggreg(note_array)
+                rows = vocab_rows[token_ids] if isinstance(text, TokenizedCorpus) else word_rows[codes]
+                # out-of-vocabulary words are skipped, the rest pooled straight from the embedding matrix
+                in_vocab = rows >= 0
+                rows, note_of_token = rows[in_vocab], note_of_token[in_vocab]
+                table = word_vectors.vectors
+            X[start:stop] = pool_rows(table, rows, np.bincount(note_of_token, minlength=stop-start))
+            start = stop
 
         if assign_to_attr:
             self.note_level_aggregations = X
@@ -75,77 +175,107 @@ class W2VEmbedAggregate(object):
         return X
 
 
+def _take(text, idx):
+    if isinstance(text, TokenizedCorpus):
+        return text.take(idx)
+    return [text[i] for i in idx]
+
+
+def _score_embedding(text, labels, train_idx, val_idx, embed_params, clf_configs, seed, subword=False):
+    '''Trains one embedding configuration on one fold and returns the validation AUROC of each
+    classifier configuration fit on its note matrices'''
+    embed_agg = W2VEmbedAggregate(patient_ids=None, subword=subword)
+    embed_agg.set_params(**embed_params)
+    train_text = _take(text, train_idx)
+    X_train = embed_agg.fit(train_text).transform(train_text, assign_to_attr=False)
+    X_val = embed_agg.transform(_take(text, val_idx), assign_to_attr=False)
+
+    scores = []
+    for clf_params in clf_configs:
+        clf = SGDClassifier(random_state=seed, **clf_params).fit(X_train, labels[train_idx])
+        scores.append(roc_auc_score(labels[val_idx], clf.decision_function(X_val)))
+
+    return scores
+
+
 class MIMICWord2VecReadmissionPredictor(object):
     '''Implementation class for the ML pipeline that goes from the cleaned/annotated
     text -> word embeddings -> SVM classification'''
 
-    def __init__(self, txtvar, st_aug, seed=1, train_chunksize=1e5, test_chunksize=1e3, db=False):
+    def __init__(self, txtvar, st_aug, seed=1, train_chunksize=1e5, test_chunksize=1e3, db=False,
+                 patient_pooling='mean', token_cache=None, subword=False):
         self.txtvar = txtvar
         self.st_aug = st_aug
         self.seed = seed
+        self.patient_pooling = patient_pooling
         self.train_chunksize = train_chunksize
         self.test_chunksize = test_chunksize
         self.db = db
-
-    def _load_data(self, corpus_fp, readm_fp, chunksize=None, adapt_for_gridsearch=False):
-        cols = ['SUBJECT_ID', 'HADM_ID', self.txtvar]
-        dtypes = {}
-        for c in cols:
-            dtypes[c] = str
-        if self.st_aug:
-            cols.append('SEMTYPES')
-            dtypes['SEMTYPES'] = str
-        corpus_df = read_csv(
-            corpus_fp,
-            index_col=0,
-            usecols=cols,
-            dtype=dtypes,
-            chunksize=chunksize
-        )
-        readm_df = read_csv(readm_fp, index_col=0)
-        patient_ids = []
-        text = []
-        readm_df = read_csv(readm_fp, index_col=0)
-        for chunk in corpus_df:
-            chunk = chunk[chunk.index.isin(readm_df.index)]
-            patient_ids += chunk.index.get_level_values(0).tolist()
-            if sum(isna(chunk[self.txtvar])) > 0:
-                chunk[self.txtvar] = chunk[self.txtvar].fillna('')
+        # directory of whitespace-tokenized corpora (see token_cache.py), None to tokenize with NLTK on every run
+        self.token_cache = token_cache
+        self.subword = subword
+
+    def _load_cached_tokens(self, corpus_fp, readm_index, chunksize):
+        corpus = TokenizedCorpus.load_or_build(corpus_fp, self.txtvar, self.st_aug, self.token_cache, chunksize)
+        label_rows = readm_index.get_indexer(corpus.subject_ids)
+        keep = np.flatnonzero(label_rows >= 0)
+        if self.db:
+            keep = keep[keep < int(chunksize)]
+
+        return corpus.take(keep), label_rows[keep]
+
+    def _iter_labelled_chunks(self, corpus_fp, readm_index, chunksize):
+        '''Yields the row of each note's patient in the label file and the tokenized notes, chunk by chunk,
+        for the notes of the patients in the label file'''
+        if self.token_cache is not None:
+            text, label_rows = self._load_cached_tokens(corpus_fp, readm_index, chunksize)
+            for start in range(0, len(text), int(chunksize)):
+                idx = np.arange(start, min(start+int(chunksize), len(text)))
+                yield label_rows[idx], text.take(idx)
+            return
+
+        for chunk in iter_txt_df(corpus_fp, self.txtvar, self.st_aug, chunksize, subject_ids=readm_index.values):
+            # row of each note's patient in the label file, -1 for patients without a label
+            rows = readm_index.get_indexer(chunk.SUBJECT_ID.values)
+            chunk = chunk[rows >= 0]
             if self.st_aug:
                 chunk = chunk.assign(
-                    **{self.txtvar:chunk[self.txtvar]+chunk.SEMTYPES.fillna('')}
+                    **{self.txtvar:chunk[self.txtvar]+chunk.SEMTYPES}
                 )
-                chunk.drop('SEMTYPES', axis=1, inplace=True)
-            for note in chunk[self.txtvar]:
-                text.append(word_tokenize(note))
+            yield rows[rows >= 0], [word_tokenize(note) for note in chunk[self.txtvar]]
             if self.db:
                 break
 
-        # labels have to be the same length as train data for the pipeline
-        # make sure that labels are ordered according to the patient IDs in the text dataset
-        readm_df = readm_df[readm_df.index.isin(patient_ids)]
+    def _load_data(self, corpus_fp, readm_fp, chunksize=None, adapt_for_gridsearch=False):
+        '''
+        Reads and tokenizes the notes of the patients in the label file. Returns the patient ID of each
+        note, the tokenized notes and the patient labels in order of each patient's first note, plus the
+        label of each note if adapt_for_gridsearch. Labels are looked up through the index of the label
+        file, which is hashed once, rather than searched for patient by patient.
+        '''
+        readm_df = read_csv(readm_fp, index_col=0)
+        readm_index = readm_df.index
+        if self.token_cache is not None:
+            text, label_rows = self._load_cached_tokens(corpus_fp, readm_index, chunksize or 1e5)
+        else:
+            text, label_rows = [], []
+            for rows, chunk_text in self._iter_labelled_chunks(corpus_fp, readm_index, chunksize or 1e5):
+                label_rows.append(rows)
+                text += chunk_text
+            label_rows = np.concatenate(label_rows) if len(label_rows) > 0 else np.zeros(0, dtype=np.int64)
+
+        patient_ids = readm_index.values[label_rows]
         input_labels = readm_df.READM.values
-        readm_ordering_map = {}
-        for p_id, label in zip(readm_df.index, input_labels):
-            readm_ordering_map[p_id] = label
 
-        # order the labels to be correspond to the output of patient aggregations
-        labels = []
-        unique_id_list = list(dict.fromkeys(patient_ids))
-        for p_id in unique_id_list:
-            labels.append(input_labels[readm_df.index.tolist().index(p_id)])
+        # order the labels to correspond to the output of patient aggregations, i.e. by first appearance
+        _, first_note = np.unique(label_rows, return_index=True)
+        labels = input_labels[label_rows[np.sort(first_note)]]
 
         if adapt_for_gridsearch:
-            gridsearch_labels = []
-            for p_id in patient_ids:
-                try:
-                    gridsearch_labels.append(readm_ordering_map[p_id])
-                except KeyError:
-                    continue
-
-            ret = tuple(np.array(patient_ids), text, np.array(labels), np.array(gridsearch_labels))
+            # labels have to be the same length as train data for the pipeline
+            ret = (patient_ids, text, labels, input_labels[label_rows])
         else:
-            ret = tuple(np.array(patient_ids), text, np.array(labels))
+            ret = (patient_ids, text, labels)
 
         return ret
 
@@ -155,82 +285,163 @@ class MIMICWord2VecReadmissionPredictor(object):
                 corpus_fp=corpus_fp, readm_fp=readm_fp, chunksize=chunksize, adapt_for_gridsearch=adapt_for_gridsearch
             )
 
-    def _load_test_data(self, corpus_fp, readm_fp):
-        self.test_patient_ids, self.test_text, self.test_labels =\
-            self._load_data(corpus_fp=corpus_fp, readm_fp=readm_fp, chunksize=1e3)
-
-    def choose_params(self, corpus_fp, readm_fp, n_jobs, use_multithreading=False):
+    def choose_params(self, corpus_fp, readm_fp, n_jobs, use_multithreading=False, search='grid', eta=3, n_rungs=3,
+                      tol=None):
+        '''
+        Picks the Word2Vec and classifier parameters by cross-validated AUROC. search='grid' scores every
+        configuration on the whole training set, search='halving' runs successive halving over the embedding
+        configurations on growing stratified subsamples of the training patients (n_rungs fractions of the
+        set, shrinking by a factor eta each), see util.successive_halving.
+        '''
         self._load_train_data(
             corpus_fp=corpus_fp, readm_fp=readm_fp, chunksize=self.train_chunksize, adapt_for_gridsearch=True
         )
-        pipeline = Pipeline(
-            steps = [
-                ('embed_agg', W2VEmbedAggregate(patient_ids=self.train_patient_ids)),
-                ('clf', SGDClassifier(random_state=self.seed))
-            ]
-        )
         lr_grid = [10**i for i in range(-4, -1)]
-        param_grid = [
-            {
-                'embed_agg__sg':[1, 0],
-                'embed_agg__size':[100, 200],
-                'embed_agg__window':[5, 7, 9],
-                'embed_agg__alpha':lr_grid,
-                'clf__alpha':lr_grid
-            }
-        ]
-        grid_w2v_sgd = GridSearchCV(
-            pipeline,
-            param_grid=param_grid,
-            refit=True,
-            n_jobs=n_jobs,
-            scoring='roc_auc',
-            cv=StratifiedKFold(n_splits=5, shuffle=True, random_state=self.seed)
-        )
+        embed_grid = {
+            'sg':[1, 0],
+            'size':[100, 200],
+            'window':[5, 7, 9],
+            'alpha':lr_grid
+        }
+        clf_grid = {'alpha':lr_grid}
+        cv = StratifiedKFold(n_splits=5, shuffle=True, random_state=self.seed)
+        budgets = halving_budgets(eta, n_rungs) if search == 'halving' else [1.0]
         if use_multithreading:
             from sklearn.utils import parallel_backend
 
             with parallel_backend('threading'):
-                gridsearch_res = grid_w2v_sgd.fit(self.train_text, self.gridsearch_labels)
+                embed_params, clf_params, score = self._search(embed_grid, clf_grid, cv, n_jobs, budgets, eta, tol)
         else:
-            gridsearch_res = grid_w2v_sgd.fit(self.train_text, self.gridsearch_labels)
-
-        self.w2v_agg_model = gridsearch_res.best_estimator_.named_steps['embed_agg']
-        self.clf = gridsearch_res.best_estimator_.named_steps['clf']
-
-    def _patient_aggregation(self, note_vectors, labels=None):
-        dim = self.w2v_agg_model.embedding.wv.vector_size
-        patient_to_nv_map = {}
-        patient_labels = []
-        if labels is not None:
-            for p_id, vector, lab in zip(self.train_patient_ids, note_vectors, labels):
-                if p_id not in patient_to_nv_map:
-                    patient_to_nv_map[p_id] = vector
-                    patient_labels.append(lab)
-                else:
-                    patient_to_nv_map[p_id] = np.vstack((patient_to_nv_map[p_id], vector))
+            embed_params, clf_params, score = self._search(embed_grid, clf_grid, cv, n_jobs, budgets, eta, tol)
+
+        # refit the best configuration on all of the training notes
+        self.w2v_agg_model = W2VEmbedAggregate(patient_ids=self.train_patient_ids, subword=self.subword)
+        self.w2v_agg_model.set_params(**embed_params)
+        self.w2v_agg_model.fit(self.train_text)
+        self.clf = SGDClassifier(random_state=self.seed, **clf_params).fit(
+            self.w2v_agg_model.transform(self.train_text), self.gridsearch_labels
+        )
+        self.best_score = score
+
+    def _search(self, embed_grid, clf_grid, cv, n_jobs, budgets, eta, tol):
+        '''
+        Runs the search over the embedding configurations at the given budgets (fractions of the training
+        patients) - with a single budget of 1 this is a plain grid search. Each embedding configuration is
+        scored by its best classifier configuration. Keeps a table of every evaluation in search_results and
+        the CPU-seconds spent in search_cpu_seconds; returns the best embedding parameters, classifier
+        parameters and mean AUROC.
+        '''
+        embed_configs = list(ParameterGrid(embed_grid))
+        clf_configs = list(ParameterGrid(clf_grid))
+        start, timings = process_time(), []
+        records = []
+        best_clf = {}
+
+        def evaluate(config_ids, budget):
+            scores = self._staged_grid_search(
+                [embed_configs[i] for i in config_ids], clf_configs, cv, n_jobs, budget, timings
+            )
+            for i, row in zip(config_ids, scores):
+                best_clf[i] = int(row.argmax())
+                records.extend(
+                    dict(budget=budget, **embed_configs[i], clf_alpha=c['alpha'], mean_auroc=s)
+                    for c, s in zip(clf_configs, row)
+                )
+            return scores.max(1)
+
+        best, score, _ = successive_halving(list(range(len(embed_configs))), evaluate, budgets, eta=eta, tol=tol)
+        self.search_results = DataFrame.from_records(records)
+        self.search_cpu_seconds = cpu_seconds(start, timings)
+        print('Search took {:.1f} CPU-seconds'.format(self.search_cpu_seconds))
+
+        return embed_configs[best], clf_configs[best_clf[best]], score
+
+    def _subsample_notes(self, fraction):
+        '''Indices of the training notes of a stratified random fraction of the training patients'''
+        if fraction >= 1:
+            return np.arange(len(self.train_patient_ids))
+        # train_labels are in order of first appearance of each patient
+        patients = np.array(list(dict.fromkeys(self.train_patient_ids)))
+        chosen = patients[stratified_subsample(self.train_labels, fraction, self.seed)]
+
+        return np.flatnonzero(np.isin(self.train_patient_ids, chosen))
+
+    def _staged_grid_search(self, embed_configs, clf_configs, cv, n_jobs, fraction=1.0, timings=None):
+        '''
+        Grid search in two stages: each distinct Word2Vec configuration is trained once per fold
+        and the resulting note matrices are reused to fit every classifier setting, rather than
+        retraining the embedding for every combination of embedding and classifier parameters.
+        Only the notes of a fraction of the training patients are used if fraction < 1.
+        Returns the mean AUROC of each embedding (rows) and classifier (columns) configuration.
+        '''
+        labels = np.asarray(self.gridsearch_labels)
+        note_idx = self._subsample_notes(fraction)
+        folds = [
+            (note_idx[train_idx], note_idx[val_idx])
+            for train_idx, val_idx in cv.split(np.zeros(len(note_idx)), labels[note_idx])
+        ]
+
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(timed)(
+                _score_embedding, self.train_text, labels, train_idx, val_idx, embed_params, clf_configs, self.seed,
+                self.subword
+            )
+            for embed_params in embed_configs for train_idx, val_idx in folds
+        )
+        if timings is not None:
+            timings.extend((t, pid) for _, t, pid in results)
+        # embedding configuration x fold x classifier configuration
+        fold_scores = np.array([r[0] for r in results])
+
+        return fold_scores.reshape((len(embed_configs), len(folds), len(clf_configs))).mean(1)
+
+    def _patient_aggregation(self, note_vectors, patient_ids, labels=None, weights=None):
+        '''
+        Pools the note vectors into one row per patient, in sorted patient ID order. patient_ids
+        and labels (optional) are the per-note arrays belonging to note_vectors, so the returned
+        patient labels line up with the rows by construction. Mean and weighted pooling (weights
+        per note, e.g. token counts) are a single sparse patient-indicator product; max pooling is
+        one segment reduction over the notes sorted by patient.
+        '''
+        patients, first_note, codes = np.unique(patient_ids, return_index=True, return_inverse=True)
+        n_patients, n_notes = len(patients), len(codes)
+
+        if self.patient_pooling in ['mean', 'weighted']:
+            if self.patient_pooling == 'weighted':
+                if weights is None:
+                    raise ValueError('weighted patient pooling needs note weights')
+                w = np.asarray(weights, dtype=np.float64)
+            else:
+                w = np.ones(n_notes)
+            totals = np.bincount(codes, weights=w, minlength=n_patients)
+            w = w/np.where(totals > 0, totals, 1)[codes]
+            indicator = csr_matrix((w, (codes, np.arange(n_notes))), shape=(n_patients, n_notes))
+            X = indicator @ note_vectors
+        elif self.patient_pooling == 'max':
+            order = np.argsort(codes, kind='mergesort')
+            if n_notes > 0:
+                seg_starts = np.flatnonzero(np.r_[True, codes[order][1:] != codes[order][:-1]])
+                X = np.maximum.reduceat(np.asarray(note_vectors)[order], seg_starts, axis=0)
+            else:
+                X = np.empty((0, note_vectors.shape[1]))
         else:
-            for p_id, vector in zip(self.train_patient_ids, note_vectors):
-                if p_id not in patient_to_nv_map:
-                    patient_to_nv_map[p_id] = vector
-                else:
-                    patient_to_nv_map[p_id] = np.vstack((patient_to_nv_map[p_id], vector))
-        X = np.empty((len(patient_to_nv_map), dim))
-        i = 0
-        for array in patient_to_nv_map.values():
-            X[i,:] = np.mean(array, 0)
-            i += 1
-
-        return X, np.array(patient_labels)
+            raise NameError('invalid string passed to patient_pooling argument')
+
+        patient_labels = None if labels is None else np.asarray(labels)[first_note]
+
+        return X, patient_labels, patients
 
     def train(self, text=None, labels=None, out_fp=None):
         if text is not None and labels is not None:
             # TODO assume we're running the full pipeline from scratch and instantiate a new embed-and-aggregate object
             pass
         else:
-            # get note-level vectors and take the mean over them for each patient
-            X, _ = self._patient_aggregation(
-                self.w2v_agg_model.note_level_aggregations
+            # get note-level vectors and pool them for each patient
+            X, train_labels, _ = self._patient_aggregation(
+                self.w2v_agg_model.note_level_aggregations,
+                self.train_patient_ids,
+                labels=self.gridsearch_labels,
+                weights=note_lengths(self.train_text)
             )
 
             # run a finer-tuned search for the best learning rate for the classifier using patient-level classifications
@@ -244,17 +455,17 @@ class MIMICWord2VecReadmissionPredictor(object):
                 scoring='roc_auc',
                 cv=StratifiedKFold(n_splits=5, random_state=self.seed)
             )
-            alpha_gridsearch_res = grid_sgd.fit(X, self.train_labels)
+            alpha_gridsearch_res = grid_sgd.fit(X, train_labels)
             if alpha_gridsearch_res.best_estimator_.alpha != current_lr:
                 self.clf.alpha = alpha_gridsearch_res.best_estimator_.alpha
 
             if out_fp is not None:
                 dev_pred = self.clf.predict(X)
                 dev_score = self.clf.decision_function(X)
-                dev_prec = precision_score(self.train_labels, dev_pred, average='weighted')
-                dev_recall = recall_score(self.train_labels, dev_pred, average='weighted')
-                dev_f1 = f1_score(self.train_labels, dev_pred, average='weighted')
-                dev_auroc = roc_auc_score(self.train_labels, dev_score, average='weighted')
+                dev_prec = precision_score(train_labels, dev_pred, average='weighted')
+                dev_recall = recall_score(train_labels, dev_pred, average='weighted')
+                dev_f1 = f1_score(train_labels, dev_pred, average='weighted')
+                dev_auroc = roc_auc_score(train_labels, dev_score, average='weighted')
                 with open(out_fp, 'w+') as model_desc:
                     model_desc.write(
                         f'''Word2Vec-based test results\nVariable {self.txtvar}
@@ -270,15 +481,42 @@ epochs {self.w2v_agg_model.embedding.iter}\n-- DEVELOPMENT RESULTS --
                         )
 
 
+    def _stream_patient_features(self, corpus_fp, readm_fp):
+        '''
+        Embeds the notes with the trained (frozen) model and pools them for each patient chunk by chunk, so
+        only one chunk of notes is held at a time. Gives the same rows, in sorted patient ID order, as
+        _patient_aggregation on the whole set: running weighted sums (or maxima) are kept for every patient
+        in the label file and patients without notes are dropped at the end.
+        '''
+        readm_df = read_csv(readm_fp, index_col=0)
+        n_rows = len(readm_df)
+        X, totals, seen = None, np.zeros(n_rows), np.zeros(n_rows, dtype=bool)
+        for rows, text in self._iter_labelled_chunks(corpus_fp, readm_df.index, self.test_chunksize):
+            note_vectors = self.w2v_agg_model.transform(text, assign_to_attr=False)
+            if X is None:
+                X = np.zeros((n_rows, note_vectors.shape[1]))
+            if self.patient_pooling in ['mean', 'weighted']:
+                w = note_lengths(text).astype(np.float64) if self.patient_pooling == 'weighted' else np.ones(len(rows))
+                X += csr_matrix((w, (rows, np.arange(len(rows)))), shape=(n_rows, len(rows))) @ note_vectors
+                totals += np.bincount(rows, weights=w, minlength=n_rows)
+            elif self.patient_pooling == 'max':
+                part, _, part_rows = self._patient_aggregation(note_vectors, rows)
+                X[part_rows] = np.where(seen[part_rows, None], np.maximum(X[part_rows], part), part)
+            else:
+                raise NameError('invalid string passed to patient_pooling argument')
+            seen[rows] = True
+
+        seen = np.flatnonzero(seen)
+        order = seen[np.argsort(readm_df.index.values[seen], kind='mergesort')]
+        if X is None:
+            return np.zeros((0, 0)), readm_df.READM.values[order], readm_df.index.values[order]
+        if self.patient_pooling in ['mean', 'weighted']:
+            X[order] /= np.where(totals[order] > 0, totals[order], 1)[:, None]
+
+        return X[order], readm_df.READM.values[order], readm_df.index.values[order]
+
     def test(self, corpus_fp, readm_fp, out_fp=None, save_model_fp=None):
-        self._load_test_data(corpus_fp, readm_fp)
-        self.w2v_agg_model.embedding.train(
-            self.test_text, total_examples=len(self.test_text), epochs=5
-        )
-        X, agg_test_labels = self._patient_aggregation(
-            self.w2v_agg_model.transform(self.test_text, assign_to_attr=False),
-            labels=self.test_labels
-        )
+        X, agg_test_labels, _ = self._stream_patient_features(corpus_fp, readm_fp)
         test_pred = self.clf.predict(X)
         test_scores = self.clf.decision_function(X)
         test_prec = precision_score(agg_test_labels, test_pred)
@@ -308,80 +546,12 @@ epochs {self.w2v_agg_model.embedding.iter}\n-- TEST RESULTS --
 # BERT IMPLEMENTATION CLASSES #
 ###############################
 
-class EncodedDataset(data.Dataset):
-    '''Pytorch-inherited dataset class that tokenizes the text batch-by-batch as
-    it is passed to the dataloader to save RAM'''
-
-    def __init__(self, df, bert_model, txtvar, seq_len):
-        tokenizer = BertTokenizer.from_pretrained(bert_model, do_lower_case=True)
-
-        # encoding has to be done during the initialisation, because torch expects all of the tensors output by __getitem__() to
-        # be of the same size, so I can't return a stack of sequences for a patient index, it has to be a single sequence for the
-        # sequence index
-        input_ids, attn_masks, labels, patient_ids = [], [], [], []
-        for patient, note, label in zip(df.SUBJECT_ID, df[txtvar], df.READM):
-            encoding = tokenizer.encode_plus(
-                note,
-                add_special_tokens=True,
-                truncation=True,
-                max_length=seq_len,
-                pad_to_max_length=True,
-                return_attention_mask=True,
-                return_tensors='pt',
-                return_overflowing_tokens=True
-            )
-            input_ids.append(encoding['input_ids'].reshape(seq_len))
-            attn_masks.append(encoding['attention_mask'].reshape(seq_len))
-            patient_ids.append(patient)
-            labels.append(label)
-
-            if 'overflowing_tokens' in encoding.keys():
-                overflow = encoding['overflowing_tokens']
-                n_overflow = len(overflow)
-                # split the overflowing tokens into sequences of size 512 and label them
-                # with the current subject identifier and label
-                for i in range(ceil(n_overflow/seq_len)):
-                    # duplicate ID and label for each sequence
-                    patient_ids.append(patient)
-                    labels.append(label)
-                    overflow_seq = overflow[seq_len*i:seq_len*(i+1)]
-                    overflow_seq_len = overflow_seq.shape[1]
-                    if overflow_seq_len == seq_len:
-                        attn_mask = torch.ones(seq_len)
-                    else:
-                        overflow_seq = torch.cat(
-                            (overflow_seq, torch.zeros(seq_len-overflow_seq_len))
-                        )
-                        attn_mask = torch.cat(
-                            (torch.ones(overflow_seq_len), torch.zeros(seq_len-overflow_seq_len))
-                        )
-                    input_ids.append(overflow_seq.long())
-                    attn_masks.append(attn_mask.long())
-
-        self.input_ids = input_ids
-        self.attn_masks = attn_masks
-        self.labels = labels
-        self.patient_ids = patient_ids
-
-    def __len__(self):
-        return len(self.patient_ids)
-
-    def __getitem__(self, idx):
-        if torch.is_tensor(idx):
-            idx = idx.tolist()
-
-        return {
-            'input_ids' : self.input_ids[idx],
-            'attn_masks' : self.attn_masks[idx],
-            'labels' : torch.tensor(self.labels[idx]),
-            'patient_ids' : torch.tensor(self.patient_ids[idx])
-        }
-
-
 class MIMICBERTReadmissionPredictor(pl.LightningModule):
     '''This class implements model hooks into the Pytorch-Lightning framework, basically
     a wrapper around Pytorch module functionality'''
 
+    collate_fn = staticmethod(collate_dynamic)
+
     def __init__(self, **kwargs):
         super().__init__()
 
@@ -392,10 +562,22 @@ class MIMICBERTReadmissionPredictor(pl.LightningModule):
         params = [
             'n_train_fp', 'r_train_fp', 'n_test_fp', 'r_test_fp', # data file paths
             'val_frac', 'batch_size', 'threads', 'optimiser', # implementation arguments
+            'cache_dir', 'tokenize_workers', # where and with how many processes the notes are encoded
+            'chunk_stride', 'chunk_policy', 'max_note_chunks', 'max_patient_chunks', # how notes are split into sequences
+            'bucket_batches', # bool: batch sequences of similar lengths together
+            'loader_workers', # DataLoader worker processes, or 'auto' to pick them with probe_loader
+            'prefetch_factor', 'persistent_workers', 'pin_memory', # DataLoader arguments used with workers
+            'train_sampling', # how training sequences are drawn: 'random', 'weighted' or 'subsample', see PatientSampler
+            'epoch_fraction', # with weighted sampling, sequences drawn per epoch as a fraction of the training set
+            'neg_ratio', # with subsampling, negative patients kept per positive patient each epoch
+            'weighted_loss', # bool: weight the training loss by the inverse frequency of each class of patients
             'bert_model', 'txtvar', 'sequence_len', 'st_aug', 'proba_aggregation_scale_factor', # language-model arguments
+            'logit_pooling', # how the logits of a patient's sequences are combined, see patient_pooling.LOGIT_POOLINGS
             'db', # boolean - debug mode
             'write_test_results_to', 'write_dev_results_to',
             'update_all_params', # bool: update the entire BERT model rather than just fine-tuning the final layer
+            'frozen_layers', # int: freeze the embeddings and this many encoder layers, and train on their cached outputs
+            'feature_cache_dir', # where cached BERT outputs go, by default next to the encoded sequences
             'verbose' #bool
         ]
 
@@ -403,11 +585,30 @@ class MIMICBERTReadmissionPredictor(pl.LightningModule):
         self.optimiser = 'sgd'
         self.threads = torch.get_num_threads()
         self.proba_aggregation_scale_factor = 2.0
+        self.logit_pooling = 'scaled'
         self.sequence_len = 256
         self.db = False
         self.write_test_results_to = None
         self.update_all_params = False
         self.verbose = False
+        self.cache_dir = None
+        self.tokenize_workers = cpu_count()
+        self.chunk_stride = 0
+        self.chunk_policy = 'all'
+        self.max_note_chunks = None
+        self.max_patient_chunks = None
+        self.bucket_batches = True
+        self.loader_workers = 'auto'
+        self.prefetch_factor = 2
+        self.persistent_workers = True
+        self.pin_memory = torch.cuda.is_available()
+        self.frozen_layers = None
+        self.train_sampling = 'random'
+        self.epoch_fraction = 1.0
+        self.neg_ratio = 1.0
+        self.weighted_loss = False
+        self.feature_cache_dir = None
+        self._last_step_time = None
 
         # load input arguments
         self.__dict__.update((k, v) for k, v in kwargs.items() if k in params)
@@ -420,6 +621,11 @@ class MIMICBERTReadmissionPredictor(pl.LightningModule):
             for name, param in self.model.named_parameters():
                 if name.startswith('embeddings'):
                     param.requires_grad = False
+        if self.frozen_layers is not None:
+            # these run once over the notes to fill the cache, and never again
+            frozen = [self.model.bert.embeddings]+list(self.model.bert.encoder.layer[:self.frozen_layers])
+            for param in chain.from_iterable(module.parameters() for module in frozen):
+                param.requires_grad = False
 
         # this function is not in versions <0.8.1
         self.save_hyperparameters('epochs', 'lr', 'momentum')
@@ -427,83 +633,160 @@ class MIMICBERTReadmissionPredictor(pl.LightningModule):
         self.metrics = (M.Accuracy(), M.Precision(), M.Recall(), M.F1(), M.AUROC())
         self.metric_names = ('acc', 'prec', 'recall', 'f1', 'auroc')
 
-    def setup(self, stage):
+    def _encoded_dataset(self, nfp, rfp):
+        # sequences are tokenized once and cached, by default next to the notes file
+        cache_dir = self.cache_dir or os.path.join(os.path.dirname(os.path.abspath(nfp)), 'bert_encodings')
+        return load_or_encode(
+            cache_dir, nfp, rfp, self.bert_model, self.txtvar, self.st_aug, self.sequence_len,
+            stride=self.chunk_stride,
+            policy=self.chunk_policy,
+            max_note_chunks=self.max_note_chunks,
+            max_patient_chunks=self.max_patient_chunks,
+            workers=self.tokenize_workers,
+            nrows=2*self.batch_size if self.db else None,
+            verbose=self.verbose
+        )
 
-        def _dataframe_setup(nfp, rfp, split=True):
-            if self.verbose:
-                print('Reading data from .csv...')
-            text_df = load_txt_df(
-                fp=nfp,
-                var=self.txtvar,
-                st_aug=self.st_aug,
-                _slice=2*self.batch_size if self.db else None
-            )
-            labelled_text = text_df.merge(read_csv(rfp, index_col=0), on='SUBJECT_ID', how='left')
+    def prepare_data(self):
+        '''
+        Encodes the training and test notes and computes the cached outputs of the frozen layers, if any, so
+        that setup() only has to load them. bert_main.py calls this before the trainer starts the DDP
+        processes: otherwise rank 0 would build the caches in setup() while the other processes wait for it at
+        a barrier, which times out (after 30 minutes by default) long before a full corpus is encoded.
+        '''
+        for nfp, rfp in [(self.n_train_fp, self.r_train_fp), (self.n_test_fp, self.r_test_fp)]:
+            self._wrap_dataset(self._encoded_dataset(nfp, rfp))
 
-            def _make_sample_weights(y):
-                class_weight = torch.as_tensor(len(y)/(len(np.unique(y))*np.bincount(y)))
-                return torch.tensor(
-                    [class_weight[0].item() if sample == 0 else class_weight[1].item() for sample in y]
-                )
+    def _wrap_dataset(self, dataset):
+        # the dataset the model trains or is tested on, from the encoded sequences
+        return dataset if self.frozen_layers is None else self._cached_dataset(dataset)
 
-            # add semantic type codes if specified
-            if self.st_aug:
-                labelled_text[self.txtvar] += labelled_text['SEMTYPES']
-                labelled_text[self.txtvar] = labelled_text[self.txtvar].apply(str)
-                labelled_text.drop('SEMTYPES', axis=1, inplace=True)
-
-            if split:
-                # do random split of patients list to ensure notes for the same patient don't get split between the training and validation sets
-                all_patients = labelled_text.SUBJECT_ID.drop_duplicates().tolist()
-                n_val_patients = int(len(all_patients)*self.val_frac)
-                val_patients = sample(all_patients, n_val_patients)
-                val_df = labelled_text[labelled_text.SUBJECT_ID.isin(val_patients)]
-                train_df = labelled_text[~labelled_text.SUBJECT_ID.isin(val_df.SUBJECT_ID)]
-
-                return train_df, val_df, _make_sample_weights(val_df.READM.values)
-            else:
-                return labelled_text, _make_sample_weights(labelled_text.READM.values)
+    def setup(self, stage):
+        # intra-op threads of the model, the loader workers run single-threaded (see loader_worker_init)
+        torch.set_num_threads(self.threads)
 
         if stage == 'fit':
             if self.verbose:
                 print('Loading training & validation datasets...')
-            self.train_df, self.val_df, self.dev_sample_weight = _dataframe_setup(self.n_train_fp, self.r_train_fp)
+            dataset = self._encoded_dataset(self.n_train_fp, self.r_train_fp)
+            # do random split of patients list to ensure notes for the same patient don't get split between the training and validation sets
+            patient_ids = dataset.patient_ids
+            all_patients = list(dict.fromkeys(patient_ids.tolist()))
+            n_val_patients = int(len(all_patients)*self.val_frac)
+            is_val = np.isin(patient_ids, sample(all_patients, n_val_patients))
+            train_ds = dataset.subset(np.flatnonzero(~is_val))
+            # inverse frequency of each class among the training patients, for weighted_loss
+            _, first = np.unique(train_ds.patient_ids, return_index=True)
+            counts = np.bincount(train_ds.labels[first])
+            self.class_weight = torch.as_tensor(len(first)/(len(counts)*counts), dtype=torch.float)
+            self.train_ds = self._wrap_dataset(train_ds)
+            self.val_ds = self._wrap_dataset(dataset.subset(np.flatnonzero(is_val)))
         if stage == 'test':
             if self.verbose:
                 print('Loading test dataset...')
-            self.test_df, self.test_sample_weight = _dataframe_setup(self.n_test_fp, self.r_test_fp, split=False)
+            self.test_ds = self._wrap_dataset(self._encoded_dataset(self.n_test_fp, self.r_test_fp))
+        if self.loader_workers == 'auto':
+            # probed once, on the training set unless the model is only being tested, whichever loader the
+            # trainer asks for first
+            self.loader_workers, _ = probe_loader(
+                self.train_ds if stage == 'fit' else self.test_ds, self.batch_size, self.collate_fn,
+                pin_memory=self.pin_memory, prefetch_factor=self.prefetch_factor, verbose=self.verbose
+            )
+            if self.verbose:
+                print('Using {} loader workers'.format(self.loader_workers))
+
+    def _cached_dataset(self, dataset):
+        '''The sequences of dataset as the outputs of the frozen layers, computed once per encoding and model
+        and stored as float16 on disk, so that every epoch and every run with other training settings (lr,
+        momentum, batch size...) only runs the layers above them'''
+        cache_dir = self.feature_cache_dir or os.path.dirname(dataset.path)
+        features = load_or_embed(
+            cache_dir, dataset, self.bert_model, self.model.bert, self.batch_size, n_layers=self.frozen_layers,
+            verbose=self.verbose
+        )
+        return CachedDataset(dataset, features)
 
     def forward(self, input_ids, attn_masks):
-        logits, = self.model(input_ids, attn_masks.float())
+        logits, = self.model(input_ids.long(), attn_masks.float())
 
         return logits
 
-    def train_dataloader(self):
-        train_ds = EncodedDataset(self.train_df, self.bert_model, self.txtvar, self.sequence_len)
+    def _batch_logits(self, batch):
+        if 'hidden_states' in batch:
+            return self._forward_cached(batch['hidden_states'], batch['attn_masks'])
+        return self.forward(batch['input_ids'], batch['attn_masks'])
+
+    def _forward_cached(self, hidden_states, attn_masks):
+        # the rest of BertForSequenceClassification's forward pass, from the output of the frozen layers
+        hidden_states = run_layers(self.model.bert.encoder.layer[self.frozen_layers:], hidden_states, attn_masks)
+        pooled = self.model.bert.pooler(hidden_states)
+
+        return self.model.classifier(self.model.dropout(pooled))
+
+    def _dataloader(self, dataset, shuffle):
+        '''
+        Batches are padded to their longest sequence, and with bucket_batches sequences of similar lengths
+        are batched together so that little of each batch is padding. The samplers are made distributed here
+        rather than by the trainer, which would drop the batch sampler (see replace_sampler_ddp in bert_main.py).
+        Training sequences can also be drawn by PatientSampler, which oversamples readmitted patients or leaves
+        out some of the others, so that an epoch is shorter and has more positives.
+        '''
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        if shuffle and self.train_sampling != 'random':
+            sampler = PatientSampler(
+                dataset.labels,
+                dataset.patient_ids,
+                mode=self.train_sampling,
+                num_samples=int(self.epoch_fraction*len(dataset)),
+                neg_ratio=self.neg_ratio,
+                num_replicas=torch.distributed.get_world_size() if distributed else 1,
+                rank=torch.distributed.get_rank() if distributed else 0
+            )
+        elif distributed:
+            sampler = data.distributed.DistributedSampler(dataset, shuffle=shuffle)
+        else:
+            sampler = data.RandomSampler(dataset) if shuffle else data.SequentialSampler(dataset)
+        if self.bucket_batches:
+            batch_sampler = BucketBatchSampler(sampler, dataset.lengths, self.batch_size, shuffle=shuffle)
+        else:
+            batch_sampler = data.BatchSampler(sampler, self.batch_size, drop_last=False)
+
         return data.DataLoader(
-            train_ds,
-            batch_size=self.batch_size,
-            sampler=data.RandomSampler(train_ds),
-            num_workers=self.threads
+            dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self.collate_fn,
+            **loader_kwargs(self.loader_workers, self.pin_memory, self.prefetch_factor, self.persistent_workers)
         )
 
+    def train_dataloader(self):
+        return self._dataloader(self.train_ds, shuffle=True)
+
     def training_step(self, batch, batch_idx):
-        logits = self.forward(batch['input_ids'], batch['attn_masks'])
-        loss = self.loss(logits, batch['labels']).mean()
+        logits = self._batch_logits(batch)
+        loss = self.loss(logits, batch['labels'])
+        if self.weighted_loss:
+            weights = self.class_weight.to(logits.device)[batch['labels']]
+            loss = (loss*weights).sum()/weights.sum()
+        else:
+            loss = loss.mean()
 
-        return {'loss':loss, 'log':{'train_loss':float(loss)}}
+        log = {'train_loss':float(loss)}
+        # throughput in real (unpadded) tokens, timed from the end of the previous step so that it includes
+        # data loading and the backward pass
+        now = perf_counter()
+        n_tokens = int(batch['attn_masks'].sum()) if 'attn_masks' in batch else 0
+        if batch_idx > 0 and self._last_step_time is not None and n_tokens > 0:
+            log['tokens_per_sec'] = n_tokens/(now-self._last_step_time)
+            log['padding_frac'] = 1-n_tokens/batch['attn_masks'].numel()
+        self._last_step_time = now
+
+        return {'loss':loss, 'log':log}
 
     def val_dataloader(self):
-        val_ds = EncodedDataset(self.val_df, self.bert_model, self.txtvar, self.sequence_len)
-        return data.DataLoader(
-            val_ds,
-            batch_size=self.batch_size,
-            sampler=data.SequentialSampler(val_ds),
-            num_workers=self.threads
-        )
+        return self._dataloader(self.val_ds, shuffle=False)
 
     def validation_step(self, batch, batch_idx):
-        logits = self.forward(batch['input_ids'], batch['attn_masks'])
+        logits = self._batch_logits(batch)
         loss = self.loss(logits, batch['labels'])
         predictions = logits.argmax(-1)
 
@@ -526,32 +809,33 @@ class MIMICBERTReadmissionPredictor(pl.LightningModule):
         return {**out, 'log':out}
 
     def test_dataloader(self):
-        test_ds = EncodedDataset(self.test_df, self.bert_model, self.txtvar, self.sequence_len)
-        return data.DataLoader(
-            test_ds,
-            batch_size=self.batch_size,
-            sampler=data.SequentialSampler(test_ds),
-            num_workers=self.threads
-        )
+        return self._dataloader(self.test_ds, shuffle=False)
 
     def test_step(self, batch, batch_idx):
-        logits = self.forward(batch['input_ids'], batch['attn_masks'])
+        logits = self._batch_logits(batch)
         loss = self.loss(logits, batch['labels'])
 
         return {
             'loss':loss.detach(),
             'logits':logits.detach(),
             'labels':batch['labels'].detach(),
+            'patient_ids':batch['patient_ids'].detach(),
             'log':{'test_loss':loss}
         }
 
     def test_epoch_end(self, outputs):
-        loss = torch.cat([o['loss'] for o in outputs]).mean()
-        logits, labels = self._aggreg_subseq_logits(outputs)
-        out = {'loss':float(loss)}
+        loss, logits, labels, patient_ids = map(
+            lambda s: torch.cat([o[s] for o in outputs], 0).cpu().numpy(), ('loss', 'logits', 'labels', 'patient_ids')
+        )
+        # metrics are calculated per patient
+        logits, labels, _ = aggregate_patient_logits(
+            logits, patient_ids, labels,
+            pooling=self.logit_pooling,
+            scale_factor=self.proba_aggregation_scale_factor
+        )
+        logits, labels = torch.as_tensor(logits), torch.as_tensor(labels)
+        out = {'loss':float(loss.mean())}
         predictions = logits.argmax(-1)
-        labels.cuda()
-        predictions.cuda()
         out.update((name, metric(predictions, labels).item()) for name, metric in zip(self.metric_names, self.metrics))
 
         if self.write_test_results_to is not None:
@@ -583,41 +867,92 @@ class MIMICBERTReadmissionPredictor(pl.LightningModule):
         else:
             raise NameError('invalid string passed to optimiser argument')
 
-    def _aggreg_subseq_logits(self, output_list):
-        '''
-        This aggregates across the estimated readmission probability for each of the
-        subsequences associated with each patient and outputs a readmission probability
-        for each patient along with the reduced list of labels with which to calculate
-        the test metrics
-        '''
-        def _scale(logits):
-            factor = len(logits)/self.proba_aggregation_scale_factor
-            return (np.max(logits)+np.mean(logits)*factor)/(1+factor)
 
-        logits, labels, patient_ids = map(
-            lambda s: [o[s] for o in output_list],
-            ('logits', 'labels', 'patient_ids')
-        )
+class AttentionPoolingHead(torch.nn.Module):
+    '''
+    Classifies patients from the embeddings of their sequences: each embedding gets an attention score,
+    the softmax of the scores over a patient's sequences weights their mean, and the pooled embedding
+    goes through a linear classifier. Embeddings come one patient after the other, chunk_counts of each.
+    '''
 
-        patient_logit_map, label_list = {}, []
-        for patient, label, i in zip(patient_ids, labels, range(logits.shape[0])):
-            if patient not in patient_logit_map:
-                patient_logit_map[patient] = logits[i,:]
-                label_list.append(label)
-            else:
-                patient_logit_map[patient] = torch.stack((patient_logit_map[patient, logits[i,:]]))
-        for j in range(logits.shape[1]):
-            out_logit_list = []
-            for _logits in patient_logit_map.values():
-                try:
-                    out_logit_list.append(_scale(_logits[:,j]))
-                except IndexError:
-                    out_logit_list.append(_logits[j])
-                if 'output_logits' in locals():
-                    output_logits = torch.cat(
-                        (output_logits, torch.tensor(out_logit_list).reshape((len(out_logit_list), 1))), dim=1
-                    )
-                else:
-                    output_logits = torch.tensor(out_logit_list).reshape((len(out_logit_list), 1))
+    def __init__(self, hidden_size, n_classes=2, attention_size=128, dropout=0.1):
+        super().__init__()
+        self.project = torch.nn.Linear(hidden_size, attention_size)
+        self.score = torch.nn.Linear(attention_size, 1, bias=False)
+        self.dropout = torch.nn.Dropout(dropout)
+        self.classifier = torch.nn.Linear(hidden_size, n_classes)
+
+    def forward(self, embeddings, chunk_counts):
+        chunk_counts = chunk_counts.to(embeddings.device)
+        n_patients, n_chunks = len(chunk_counts), int(chunk_counts.max()) if len(chunk_counts) > 0 else 0
+        # patient and position of each sequence in a (patients, chunks) grid, the rest of which is masked
+        patient = torch.repeat_interleave(torch.arange(n_patients, device=embeddings.device), chunk_counts)
+        starts = torch.cumsum(chunk_counts, 0)-chunk_counts
+        position = torch.arange(len(embeddings), device=embeddings.device)-torch.repeat_interleave(starts, chunk_counts)
+        padded = embeddings.new_zeros(n_patients, n_chunks, embeddings.shape[-1])
+        padded[patient, position] = embeddings
+        mask = torch.zeros(n_patients, n_chunks, dtype=torch.bool, device=embeddings.device)
+        mask[patient, position] = True
+
+        scores = self.score(torch.tanh(self.project(self.dropout(padded)))).squeeze(-1)
+        weights = torch.softmax(scores.masked_fill(~mask, float('-inf')), 1)
+        pooled = (weights.unsqueeze(-1)*padded).sum(1)
+
+        return self.classifier(self.dropout(pooled))
+
+
+class MIMICBERTPatientPredictor(MIMICBERTReadmissionPredictor):
+    '''
+    Patient-level version of MIMICBERTReadmissionPredictor: each training example is a patient rather
+    than a sequence. The [CLS] embeddings of a patient's sequences (at most patient_chunks of them, the
+    last ones) are pooled by an AttentionPoolingHead, so each patient's label is counted once. With
+    freeze_bert the embeddings come from the pre-trained model and are computed once and cached on disk
+    (see bert_features.py), after which training only runs the head and never BERT; otherwise BERT is
+    trained through the head. batch_size is the number of patients per batch.
+    '''
+
+    collate_fn = staticmethod(collate_patients)
+
+    def __init__(self, **kwargs):
+        # the patient-level model caches the [CLS] embeddings rather than the outputs of some layers
+        super().__init__(**dict(kwargs, frozen_layers=None))
+
+        params = [
+            'patient_chunks', # maximum number of sequences per patient
+            'freeze_bert', # bool: train the head on cached embeddings of the pre-trained model
+            'head_dropout'
+        ]
+
+        # default arguments
+        self.patient_chunks = 32
+        self.freeze_bert = True
+        self.head_dropout = 0.1
+
+        # load input arguments
+        self.__dict__.update((k, v) for k, v in kwargs.items() if k in params)
+
+        self.head = AttentionPoolingHead(self.model.config.hidden_size, dropout=self.head_dropout)
+        if self.freeze_bert:
+            for param in self.model.parameters():
+                param.requires_grad = False
+
+    def _patient_dataset(self, dataset):
+        features = None
+        if self.freeze_bert:
+            cache_dir = self.feature_cache_dir or os.path.dirname(dataset.path)
+            features = load_or_embed(
+                cache_dir, dataset, self.bert_model, self.model.bert, self.batch_size, verbose=self.verbose
+            )
+        return PatientDataset(dataset, self.patient_chunks, features)
+
+    def _wrap_dataset(self, dataset):
+        # the sequences are split by patient already, so the patient-level datasets follow the same split
+        return self._patient_dataset(dataset)
+
+    def _batch_logits(self, batch):
+        if 'features' in batch:
+            embeddings = batch['features']
+        else:
+            embeddings = self.model.bert(batch['input_ids'].long(), batch['attn_masks'].float())[0][:, 0]
 
-        return output_logits, torch.tensor(label_list)
+        return self.head(embeddings, batch['chunk_counts'])
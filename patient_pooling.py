@@ -0,0 +1,43 @@
+import numpy as np
+
+
+def _scaled_pooling(max_logits, mean_logits, counts, scale_factor):
+    # the more sequences a patient has the more weight goes to their mean, n/scale_factor to 1
+    factor = (counts/scale_factor)[:, None]
+    return (max_logits+mean_logits*factor)/(1+factor)
+
+
+# functions of the per-patient maximum and mean of the logits, the number of sequences of each patient
+# and the scale factor, returning the patient-level logits
+LOGIT_POOLINGS = {
+    'scaled':_scaled_pooling,
+    'mean':lambda max_logits, mean_logits, counts, scale_factor: mean_logits,
+    'max':lambda max_logits, mean_logits, counts, scale_factor: max_logits
+}
+
+
+def aggregate_patient_logits(logits, patient_ids, labels=None, pooling='scaled', scale_factor=2.0):
+    '''
+    Aggregates the logits of the sequences of each patient into one row per patient, in sorted patient
+    ID order, along with each patient's label. The sequences are sorted by patient once and the maximum
+    and mean of each patient's segment are taken with segment reductions, which are then combined by
+    pooling, a key of LOGIT_POOLINGS or a function with the same arguments.
+    '''
+    logits = np.asarray(logits, dtype=np.float64)
+    patient_ids = np.asarray(patient_ids)
+    order = np.argsort(patient_ids, kind='mergesort')
+    sorted_ids = patient_ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]]) if len(order) > 0\
+        else np.zeros(0, dtype=np.int64)
+    counts = np.diff(np.r_[starts, len(order)])
+    if len(order) > 0:
+        sorted_logits = logits[order]
+        max_logits = np.maximum.reduceat(sorted_logits, starts, axis=0)
+        mean_logits = np.add.reduceat(sorted_logits, starts, axis=0)/counts[:, None]
+    else:
+        max_logits = mean_logits = np.zeros((0, logits.shape[1] if logits.ndim == 2 else 0))
+    pool = LOGIT_POOLINGS[pooling] if isinstance(pooling, str) else pooling
+    patient_logits = pool(max_logits, mean_logits, counts, scale_factor)
+    patient_labels = None if labels is None else np.asarray(labels)[order[starts]]
+
+    return patient_logits, patient_labels, sorted_ids[starts]
@@ -1,3 +1,4 @@
+import os
 import pandas as pd
 from argparse import ArgumentParser
 from warnings import simplefilter
@@ -6,8 +7,11 @@ from warnings import simplefilter
 def main(args):
     assert((args.frac > 0.0) and (args.frac <= 0.4))
 
-    ndf = pd.read_csv('../data/mimic_experiment_writes/all_data.csv',
-                      index_col=0)
+    if os.path.isdir(args.notes_fp):
+        # columnar store made by corpus_store.py
+        ndf = pd.read_parquet(args.notes_fp)
+    else:
+        ndf = pd.read_csv(args.notes_fp, index_col=0)
     adf = pd.read_csv(args.rdf_in, index_col=0) # Readmissions dataset
 
     print('Initial data: Note events dataset: {:d} entries, {:d} admissions of {:d} patients'\
@@ -47,6 +51,8 @@ if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('rdf_in', type=str)
     parser.add_argument('ddir', type=str)
+    parser.add_argument('--notes_fp', type=str, default='../data/mimic_experiment_writes/all_data.csv',
+        help='annotated notes .csv file, or a directory made from one by corpus_store.py')
     parser.add_argument('--frac', type=float, default=0.2)
     parser.add_argument('--seed', type=int, default=18520)
 
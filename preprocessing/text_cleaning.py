@@ -1,9 +1,37 @@
 import re
 from argparse import ArgumentParser
-from nltk import word_tokenize, sent_tokenize
+from collections import deque
+from multiprocessing import Pool, cpu_count
+from nltk import word_tokenize
 from nltk.corpus import stopwords
 from pandas import DataFrame, read_csv
-from sys import stdout
+from tqdm import tqdm
+
+
+NON_ALPHA = re.compile('[^a-zA-Z.]')
+WHITESPACE = re.compile(r'\s+')
+
+# filled in once per worker process by _init_worker, rather than calling
+# stopwords.words() for every token
+STOPWORDS = frozenset()
+
+
+def _init_worker(stopword_set):
+    global STOPWORDS
+    STOPWORDS = stopword_set
+
+
+def clean_note(note):
+    text = WHITESPACE.sub(' ', NON_ALPHA.sub(' ', note.lower()))
+    return ' '.join([w for w in word_tokenize(text) if w not in STOPWORDS])
+
+
+def _clean_chunk(chunk):
+    return DataFrame({
+        'SUBJECT_ID':chunk.SUBJECT_ID.values,
+        'HADM_ID':chunk.HADM_ID.values,
+        'TEXT':[clean_note(note) for note in chunk.TEXT.values]
+    })
 
 
 def main(args):
@@ -12,29 +40,40 @@ def main(args):
     dtypes = {}
     for c in cols:
         dtypes[c] = str
-    ndf_iter = read_csv(args.input_fp, usecols=cols, dtype=dtypes, chunksize=1)
-
-    clean_df = DataFrame()
-    notes, patients, admissions = [], [], []
-    print('Iterating over dataset...\nNotes cleaned:')
-    i = 0
-    for chunk in ndf_iter:
-        patients.append(chunk.SUBJECT_ID.values[0])
-        admissions.append(chunk.HADM_ID.values[0])
-        text = re.sub('[^a-zA-Z.]', ' ', chunk.TEXT.values[0].lower())
-        words = word_tokenize(re.sub(r'\s+', ' ', text))
-        notes.append(' '.join([w for w in words if w not in stopwords.words('english')]))
-        i += 1
-        stdout.write('\r')
-        stdout.flush()
-        stdout.write(str(i))
-        stdout.flush()
-
-    clean_df['SUBJECT_ID'] = patients
-    clean_df['HADM_ID'] = admissions
-    clean_df['TEXT'] = notes
-
-    clean_df.to_csv(args.notes_output_name, index=False)
+    ndf_iter = read_csv(args.input_fp, usecols=cols, dtype=dtypes, chunksize=args.chunksize)
+
+    # chunks are handed out to the pool as they are read and written back in
+    # the same order; only a bounded number of them are in flight at any time
+    # so memory use doesn't depend on the size of the input file
+    max_pending = 2*args.workers
+    pending = deque()
+    header = True
+    print('Iterating over dataset...')
+    stopword_set = frozenset(stopwords.words('english'))
+    with Pool(args.workers, initializer=_init_worker, initargs=(stopword_set,)) as pool, \
+            tqdm(unit='notes') as progress:
+
+        def _write_next():
+            nonlocal header
+            clean_chunk = pending.popleft().get()
+            clean_chunk.to_csv(
+                args.notes_output_name,
+                mode='w' if header else 'a',
+                header=header,
+                index=False
+            )
+            header = False
+            progress.update(len(clean_chunk))
+
+        for chunk in ndf_iter:
+            chunk['TEXT'] = chunk.TEXT.fillna('')
+            pending.append(pool.apply_async(_clean_chunk, (chunk,)))
+            if len(pending) >= max_pending:
+                _write_next()
+        while pending:
+            _write_next()
+
+    print('==========')
 
 
 if __name__ == '__main__':
@@ -42,5 +81,9 @@ if __name__ == '__main__':
     parser.add_argument('input_fp', type=str, help='path to NOTEEVENTS file')
     parser.add_argument('-n', dest='notes_output_name', type=str, default='cleaned-noteevents.csv',
         help='path for output .csv file containing cleaned notes')
+    parser.add_argument('-c', dest='chunksize', type=int, default=10000,
+        help='number of notes read from the input file and passed to a worker at a time')
+    parser.add_argument('-w', dest='workers', type=int, default=cpu_count(),
+        help='number of worker processes, defaults to the number of CPUs')
 
     main(parser.parse_args())
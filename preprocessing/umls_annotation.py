@@ -1,146 +1,369 @@
+import os
 import re
+import json
+import shutil
+import pickle
+import sqlite3
 import nltk
 from argparse import ArgumentParser
+from collections import OrderedDict
+from hashlib import blake2b
+from multiprocessing import Pool, cpu_count
 from nltk.corpus import stopwords
 from pandas import read_csv
 from quickumls import QuickUMLS
 from operator import itemgetter
-from tqdm import tqdm
 
 
-def main(args):
-    print('=============')
-    if args.granularity not in ['N', 'S', 'W']:
-        raise TypeError('Invalid value for the granularity - should be N, S, or W')
+NAMES = ['term', 'cui', 'semtypes']
+
+# options which change the contents of the shard files - a rerun with different
+# values for any of these can't reuse the checkpoints of a previous run
+SHARD_SETTINGS = ['noteevents_fp', 'qumls_fp', 'granularity', 'thresh', 'sim', 'attr', 'keep_similarity',
+                  'filter_semtypes_file', 'shards', 'shard_by']
+
+
+class MatchCache(object):
+    '''Bounded LRU cache in front of the QuickUMLS matcher, keyed by the normalised span text
+    and the matcher settings. New results are also written to an sqlite database, which is
+    looked up on a memory miss so that the cache can be shared by several worker processes
+    and reused by later runs'''
+
+    def __init__(self, match_fn, settings, db_fp=None, max_size=100000):
+        self.match_fn = match_fn
+        self.max_size = max_size
+        self.memory = OrderedDict()
+        self.pending = {}
+        self.hits, self.disk_hits, self.misses = 0, 0, 0
+        # the settings are hashed into every key, so results for different thresholds or
+        # similarity measures can live in the same database
+        self.settings = json.dumps(settings, sort_keys=True).encode()
+        self.db = None
+        if db_fp is not None:
+            self.db = sqlite3.connect(db_fp, timeout=600)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS matches (key BLOB PRIMARY KEY, result BLOB)')
+            self.db.commit()
+
+    def _key(self, span):
+        return blake2b(self.settings+span.encode(), digest_size=16).digest()
+
+    def __call__(self, span):
+        span = ' '.join(span.split())
+        key = self._key(span)
+        if key in self.memory:
+            self.hits += 1
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        result = None
+        if self.db is not None:
+            row = self.db.execute('SELECT result FROM matches WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self.disk_hits += 1
+                result = pickle.loads(row[0])
+        if result is None:
+            self.misses += 1
+            result = self.match_fn(span)
+            self.pending[key] = result
+            if len(self.pending) >= self.max_size:
+                self.flush()
+
+        self.memory[key] = result
+        if len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+        return result
+
+    def flush(self):
+        '''Writes the results computed since the last flush to the database'''
+        if self.db is not None and len(self.pending) > 0:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO matches VALUES (?, ?)',
+                ((k, pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL)) for k, v in self.pending.items())
+            )
+            self.db.commit()
+        self.pending = {}
+
+    def stats(self):
+        n = max(self.hits+self.disk_hits+self.misses, 1)
+        return '{:d} lookups: {:.1f}% memory hits, {:.1f}% disk hits, {:.1f}% sent to the matcher'.format(
+            self.hits+self.disk_hits+self.misses, 100*self.hits/n, 100*self.disk_hits/n, 100*self.misses/n
+        )
+
+    def close(self):
+        self.flush()
+        if self.db is not None:
+            self.db.close()
 
-    print('Reading MIMIC-III data...')
-    if args.skiplims is None:
-        notes_df = read_csv(args.noteevents_fp)
-    else:
-        to_skip = []
-        for i in range(0, len(args.skiplims), 2):
-            to_skip += [j for j in range(args.skiplims[i], args.skiplims[i+1])]
-        notes_df = read_csv(args.noteevents_fp, skiprows=to_skip)
-
-    print('Preprocessing notes ...')
-    parsed_list = []
-    for note in tqdm(notes_df['TEXT']):
-        note = note.lower()
-        note = re.sub('[^a-zA-Z.]', ' ', note)
-        note = re.sub(r'\s+', ' ', note)
-
-        # For finer granularity than entire notes, they are tokenized so that we
-        # can iterate over sentences or words
-        if args.granularity != 'N':
-            note = nltk.sent_tokenize(note)
-            if args.granularity == 'W':
-                for i in range(len(note)):
-                    note[i] = re.sub('[.]', '', note[i])
-                    note = [nltk.word_tokenize for sentence in note]
-                    for i in range(len(note)):
-                        note[i] = [word for word in note_[i] if word not in stopwords.words('english')]
-
-        parsed_list.append(note)
-
-    print('Matching with UMLS corpus...')
-    # initialise QuickUMLS string matching object
-    matcher = QuickUMLS(args.qumls_fp, threshold=args.thresh, similarity_name=args.sim)
 
-    # useful to define these two here so the mapping loop isn't too verbose
-    qumls_getter = lambda n: matcher.match(n, best_match=False, ignore_syntax=False)
+def parse_note(note, granularity, stopword_set):
+    '''Cleans a note and splits it into the list of spans that are passed to the matcher'''
+    note = note.lower()
+    note = re.sub('[^a-zA-Z.]', ' ', note)
+    note = re.sub(r'\s+', ' ', note)
+
+    # For finer granularity than entire notes, they are tokenized so that we
+    # can iterate over sentences or words
+    if granularity == 'N':
+        return [note]
+    sentences = nltk.sent_tokenize(note)
+    if granularity == 'S':
+        return sentences
+    return [
+        word for sentence in sentences for word in nltk.word_tokenize(re.sub('[.]', '', sentence))
+        if word not in stopword_set
+    ]
+
+
+def load_semtype_filter(fp):
+    '''Reads the file of semantic type identifiers to filter out, one per line'''
+    with open(fp, 'r') as f:
+        return frozenset(line.strip() for line in f if line.strip() != '')
+
+
+def _join_tokens(tokens):
+    # mapped notes keep a trailing space so that the semantic types can be appended directly
+    return ' '.join(tokens)+' ' if len(tokens) > 0 else ''
+
+
+def annotate_note(spans, qumls_getter, args, irrelevant_type_ids=None):
+    '''Maps the spans of a note to UMLS concepts, returning the mapped note (a dictionary of
+    mapped notes for each attribute if all of them are used) and its similarity scores'''
     # this gets the maximum similarity score and its index in the list for that ngram
     simscore_getter = lambda l: max(enumerate([d['similarity'] for d in l]), key=itemgetter(1))
 
     ALL = args.attr == 'all'
+    if ALL:
+        # note-level mini-version of the dictionary of attributes
+        sub_attr = {}
+        for name in NAMES:
+            sub_attr[name] = []
+    else:
+        single_attr_list = []
+    sim_list = []
+
+    for span in spans:
+        for l in qumls_getter(span):
+            ss = simscore_getter(l)
+            if ALL:
+                for name in NAMES:
+                    sub_attr[name].append(l[ss[0]][name])
+            else:
+                single_attr_list.append(l[ss[0]][args.attr])
+            sim_list.append(ss[1])
 
     if ALL:
-        # make a dictionary which will have the columns to be added to the dataframe
-        names = ['term', 'cui', 'semtypes']
-        attrs = {}
-        for name in names:
-            attrs[name] = []
+        if irrelevant_type_ids is not None:
+            # drop the concepts whose semantic types are all in the filter list
+            keep = [
+                i for i, st_set in enumerate(sub_attr['semtypes']) if not irrelevant_type_ids.issuperset(st_set)
+            ]
+            for name in NAMES:
+                sub_attr[name] = [sub_attr[name][i] for i in keep]
+            sim_list = [sim_list[i] for i in keep]
+        sub_attr['semtypes'] = [st for st_set in sub_attr['semtypes'] for st in st_set]
+        mapped = {}
+        for name in NAMES:
+            mapped[name] = _join_tokens(sub_attr[name])
     else:
-        mapped_corpus = []
-    if args.keep_similarity: similarity_scores = []
-
-    for note in tqdm(parsed_list):
-        if ALL:
-            # note-level mini-version of the dictionary "attrs" to collect the attributes for each note
-            sub_attr = {}
-            for name in names:
-                sub_attr[name] = []
-        else:
-            single_attr_list = []
-        if args.keep_similarity: sim_list = []
-        if args.granularity == 'N':
-            res = qumls_getter(note)
-            for l in res:
-                ss = simscore_getter(l)
-                if ALL:
-                    for name in names:
-                        sub_attr[name].append(l[ss[0]][name])
-                else:
-                    single_attr_list.append(l[ss[0]][args.attr])
-                if args.keep_similarity: sim_list.append(ss[1])
-        else:
-            for s in note:
-                if args.granularity != 'W':
-                    res = qumls_getter(s)
-                    for l in res:
-                        ss = simscore_getter(l)
-                        if ALL:
-                            for name in names:
-                                sub_attr[name].append(l[ss[0]][name])
-                        else:
-                            single_attr_list.append(l[ss[0]][args.attr])
-                        if args.keep_similarity: sim_list.append(ss[1])
-                else:
-                    for w in s:
-                        res = qumls_getter(w)[0]
-                        ss = simscore_getter(res)
-                        if ALL:
-                            for name in names:
-                                sub_attr[name].append(res[ss[0]][name])
-                        else:
-                            single_attr_list.append(res[ss[0]][args.attr])
-                        if args.keep_similarity: sim_list.append(ss[1])
-        if ALL:
-            if args.filter_semtypes_file is not None:
-                irrelevant_type_ids = [i[:-1] for i in open(args.filter_semtypes_file, 'r')]
-                indices_to_remove = []
-                for st_set in sub_attr['semtypes']:
-                    if all(st in irrelevant_type_ids for st in st_set):
-                        indices_to_remove.append(sub_attr['semtypes'].index(st_set))
-                for name in names:
-                    sub_attr[name] = [st for st in sub_attr[name] if sub_attr[name].index(st) not in indices_to_remove]
-            for name in names:
-                mapped_note = ''
-                for a in sub_attr[name]:
-                    if name == 'semtypes':
-                        for a_ in a:
-                            mapped_note += a_+' '
-                    else:
-                        mapped_note += a+' '
-                attrs[name].append(mapped_note)
+        mapped = _join_tokens(single_attr_list)
+
+    return mapped, ' '.join(str(s) for s in sim_list)
+
+
+def _count_rows(fp):
+    return sum(len(chunk) for chunk in read_csv(fp, usecols=['SUBJECT_ID'], dtype=str, chunksize=100000))
+
+
+def _shard_bounds(args):
+    '''Row ranges of each shard when sharding by row - subject-hashed shards don't need any'''
+    if args.shard_by != 'rows':
+        return [None]*args.shards
+    n_rows = _count_rows(args.noteevents_fp)
+    edges = [i*n_rows//args.shards for i in range(args.shards+1)]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def _iter_shard(args, shard, bounds):
+    '''Yields (position in shard, chunk) pairs covering all of the notes that belong to one shard'''
+    if args.shard_by == 'rows':
+        start, stop = bounds
+        if stop == start:
+            return
+        reader = read_csv(
+            args.noteevents_fp,
+            dtype=str,
+            skiprows=range(1, start+1),
+            nrows=stop-start,
+            chunksize=args.checkpoint_every
+        )
+        pos = 0
+        for chunk in reader:
+            yield pos, chunk
+            pos += len(chunk)
+    else:
+        # every worker has to read through the whole file to find its patients, but this
+        # is negligible next to the cost of the matching
+        reader = read_csv(args.noteevents_fp, dtype=str, chunksize=args.checkpoint_every*args.shards)
+        pos = 0
+        for chunk in reader:
+            chunk = chunk[chunk.SUBJECT_ID.astype(int) % args.shards == shard]
+            if len(chunk) > 0:
+                yield pos, chunk
+                pos += len(chunk)
+
+
+def _shard_dir(args, shard):
+    return os.path.join(args.shard_dir, 'shard_{:04d}'.format(shard))
+
+
+def _part_files(shard_dir):
+    return sorted(f for f in os.listdir(shard_dir) if f.startswith('part_') and f.endswith('.csv'))
+
+
+def _rows_done(shard_dir):
+    '''Number of notes of a shard already written to its checkpoint files'''
+    parts = _part_files(shard_dir)
+    if len(parts) == 0:
+        return 0
+    return max(int(f[:-4].split('_')[2]) for f in parts)
+
+
+def _annotate_shard(args, shard, bounds):
+    '''Matches the notes of one shard, writing a checkpoint file every args.checkpoint_every notes
+    so that an interrupted run can pick up where it left off'''
+    shard_dir = _shard_dir(args, shard)
+    os.makedirs(shard_dir, exist_ok=True)
+    if os.path.exists(os.path.join(shard_dir, 'DONE')):
+        return shard
+
+    done = _rows_done(shard_dir)
+    if done > 0:
+        print('Shard {:d}: resuming after {:d} notes'.format(shard, done))
+
+    # each worker process needs its own QuickUMLS string matching object
+    matcher = QuickUMLS(args.qumls_fp, threshold=args.thresh, similarity_name=args.sim)
+    qumls_getter = MatchCache(
+        lambda n: matcher.match(n, best_match=False, ignore_syntax=False),
+        settings={
+            'qumls_fp':os.path.abspath(args.qumls_fp),
+            'thresh':args.thresh,
+            'sim':args.sim
+        },
+        db_fp=args.match_cache,
+        max_size=args.cache_size
+    )
+    stopword_set = frozenset(stopwords.words('english'))
+    irrelevant_type_ids = None
+    if args.filter_semtypes_file is not None:
+        irrelevant_type_ids = load_semtype_filter(args.filter_semtypes_file)
+
+    for start, chunk in _iter_shard(args, shard, bounds):
+        stop = start+len(chunk)
+        if stop <= done:
+            continue
+        if start < done:
+            chunk = chunk.iloc[done-start:]
+            start = done
+
+        mapped_notes, sim_scores = [], []
+        for note in chunk['TEXT'].fillna(''):
+            mapped, sims = annotate_note(
+                parse_note(note, args.granularity, stopword_set), qumls_getter, args, irrelevant_type_ids
+            )
+            mapped_notes.append(mapped)
+            sim_scores.append(sims)
+
+        if args.attr == 'all':
+            for name in NAMES:
+                chunk[name.upper()] = [m[name] for m in mapped_notes]
         else:
-            mapped_note = ''
-            for word in single_attr_list:
-                mapped_note += word
-                mapped_note += ' '
-            mapped_corpus.append(mapped_note)
+            chunk[args.attr.upper()] = mapped_notes
+        if args.keep_similarity:
+            chunk['SIM_SCORE'] = sim_scores
 
-    print('Matching finished!')
+        # write to a temporary file first so that a crash can't leave a half-written checkpoint
+        part_fp = os.path.join(shard_dir, 'part_{:09d}_{:09d}.csv'.format(start, stop))
+        chunk.to_csv(part_fp+'.tmp', index=False)
+        os.replace(part_fp+'.tmp', part_fp)
+        qumls_getter.flush()
+        print('Shard {:d}: {:d} notes annotated'.format(shard, stop))
 
-    print('Writing .csv file...')
-    if ALL:
-        for name, mapped_corpus in attrs.items():
-            notes_df[name.upper()] = mapped_corpus
-        if args.keep_similarity: notes_df['SIM_SCORE'] = sim_list
+    open(os.path.join(shard_dir, 'DONE'), 'w').close()
+    print('Shard {:d} match cache: {}'.format(shard, qumls_getter.stats()))
+    qumls_getter.close()
+
+    return shard
+
+
+def _annotate_shard_star(shard_args):
+    return _annotate_shard(*shard_args)
+
+
+def _check_shard_settings(args):
+    '''Makes sure that existing checkpoints in the shard directory were made with the same settings'''
+    settings = dict((k, args.__getattribute__(k)) for k in SHARD_SETTINGS)
+    settings_fp = os.path.join(args.shard_dir, 'settings.json')
+    if os.path.exists(settings_fp):
+        with open(settings_fp, 'r') as f:
+            previous = json.load(f)
+        if previous != settings:
+            raise ValueError('''Shard directory {} contains the results of a run with different
+                settings - remove it or choose another directory with -d'''.format(args.shard_dir))
     else:
-        notes_df[args.attr.upper()] = mapped_corpus
+        os.makedirs(args.shard_dir, exist_ok=True)
+        with open(settings_fp, 'w+') as f:
+            json.dump(settings, f)
+
+
+def _merge_shards(args):
+    '''Concatenates the checkpoint files of all shards into the output file'''
+    header = True
+    with open(args.outfilepath, 'w+') as out:
+        for shard in range(args.shards):
+            shard_dir = _shard_dir(args, shard)
+            for part in _part_files(shard_dir):
+                with open(os.path.join(shard_dir, part), 'r') as f:
+                    # all of the parts are written with the same header line
+                    first_line = f.readline()
+                    if header:
+                        out.write(first_line)
+                        header = False
+                    shutil.copyfileobj(f, out)
+
+
+def main(args):
+    print('=============')
+    if args.granularity not in ['N', 'S', 'W']:
+        raise TypeError('Invalid value for the granularity - should be N, S, or W')
 
     if args.outfilepath[-4:] != '.csv': args.outfilepath += '.csv'
-    notes_df.to_csv(args.outfilepath, index=False)
+    if args.shard_dir is None:
+        args.shard_dir = args.outfilepath[:-4]+'_shards'
+    _check_shard_settings(args)
+    if args.match_cache is None:
+        args.match_cache = os.path.join(args.shard_dir, 'match_cache.sqlite')
+
+    todo = [
+        (args, shard, bounds) for shard, bounds in enumerate(_shard_bounds(args))
+        if not os.path.exists(os.path.join(_shard_dir(args, shard), 'DONE'))
+    ]
+    print('Matching with UMLS corpus: {:d} of {:d} shards left to do...'.format(len(todo), args.shards))
+    if len(todo) > 0:
+        n_workers = min(args.workers, len(todo))
+        if n_workers == 1:
+            for shard_args in todo:
+                _annotate_shard_star(shard_args)
+                print('Shard {:d} finished'.format(shard_args[1]))
+        else:
+            with Pool(n_workers) as pool:
+                for shard in pool.imap_unordered(_annotate_shard_star, todo):
+                    print('Shard {:d} finished'.format(shard))
+    print('Matching finished!')
+
+    print('Merging shards into .csv file...')
+    _merge_shards(args)
 
     print('Done!')
     print('=============')
@@ -161,9 +384,23 @@ if __name__ == '__main__':
         help='''Attribute of QuickUMLS return list to extract - the default is "all"''')
     parser.add_argument('-o', dest='outfilepath', type=str, default='umls_noteevents', help='''Optional output file
         path for the cleaned csv''')
-    parser.add_argument('-r', dest='skiplims', nargs='+', type=int, help='''To only use a subset of the MIMIC-III notes
-        file, list start and end points (line numbers) delimiting sections of the file for pandas.read_csv to skip when
-        reading it''')
+    parser.add_argument('-n', dest='shards', type=int, default=1, help='''Number of shards to split the notes into,
+        default 1''')
+    parser.add_argument('-b', dest='shard_by', type=str, default='rows', choices=['rows', 'subject'], help='''Split
+        the notes into contiguous row ranges ("rows" - default) or by a hash of the SUBJECT_ID ("subject")''')
+    parser.add_argument('-w', dest='workers', type=int, default=cpu_count(), help='''Number of worker processes,
+        each of which matches one shard at a time with its own QuickUMLS instance (the QuickUMLS data has to be
+        installed with a database backend that can be opened by several processes at once)''')
+    parser.add_argument('-c', dest='checkpoint_every', type=int, default=1000, help='''Number of notes after which
+        each shard writes its results to disk, default 1000''')
+    parser.add_argument('-d', dest='shard_dir', type=str, default=None, help='''Directory for the shard checkpoint
+        files - rerunning with the same directory skips the notes that have already been annotated. Defaults to
+        the output file path with a "_shards" suffix''')
+    parser.add_argument('-mc', dest='match_cache', type=str, default=None, help='''Path to the sqlite database in
+        which match results are cached - it can be reused across runs and output files. Defaults to a file in the
+        shard directory''')
+    parser.add_argument('-ms', dest='cache_size', type=int, default=100000, help='''Maximum number of match
+        results each worker keeps in memory, default 100000''')
     parser.add_argument('-ks', dest='keep_similarity', action='store_true', help='''Include this flag to keep the
         similarity scores of each UMLS concept found to be used in the aggregation step''')
     parser.add_argument('-ff', dest='filter_semtypes_file', type=str, default=None, help='''Include this
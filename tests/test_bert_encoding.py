@@ -0,0 +1,155 @@
+import os
+import json
+import numpy as np
+import torch
+from torch.utils.data import DistributedSampler
+from bert_encoding import ARRAYS, META_FILE, EncodedDataset, PatientDataset, collate_patients, select_windows,\
+    build_sequences, BucketBatchSampler, PatientSampler
+
+
+def _write_encoding(path, lengths, patient_ids, seq_len=8):
+    # the files encode() writes, for sequences of the given numbers of real tokens
+    lengths = np.asarray(lengths)
+    attn_masks = (np.arange(seq_len)[None, :] < lengths[:, None]).astype(ARRAYS['attn_masks'])
+    arrays = {
+        'input_ids':np.where(attn_masks, np.arange(1, seq_len+1)[None, :], 0),
+        'attn_masks':attn_masks,
+        'patient_ids':np.asarray(patient_ids),
+        'labels':np.asarray(patient_ids) % 2
+    }
+    for name, dtype in ARRAYS.items():
+        arrays[name].astype(dtype).tofile(os.path.join(path, name+'.bin'))
+    with open(os.path.join(path, META_FILE), 'w+') as f:
+        json.dump({'sequence_len':seq_len, 'n_sequences':len(lengths)}, f)
+
+
+def test_patient_dataset_keeps_last_chunks_of_each_patient(tmp_path):
+    # sequences of three patients in no particular order, patient 2 with three of them
+    _write_encoding(str(tmp_path), lengths=[3, 2, 6, 4, 5, 7], patient_ids=[2, 1, 2, 1, 3, 2])
+    patients = PatientDataset(EncodedDataset(str(tmp_path)), max_chunks=2)
+    assert len(patients) == 3
+    assert patients.patient_ids.tolist() == [1, 2, 3]
+    assert patients.labels.tolist() == [1, 0, 1]
+    assert patients.lengths.tolist() == [2, 2, 1]
+    # patient 2's last two sequences in file order
+    assert patients.rows.tolist() == [1, 3, 2, 5, 4]
+
+    batch = patients.__getitems__([1, 2])
+    assert batch['input_ids'].shape == (3, 7)
+    assert batch['attn_masks'].sum(1).tolist() == [6, 7, 5]
+    assert batch['chunk_counts'].tolist() == [2, 1]
+    assert batch['labels'].tolist() == [0, 1]
+
+
+def test_collate_patients_of_different_lengths(tmp_path):
+    # patient 1's sequences are 3 tokens long at most, patient 2's 6 and patient 3's 5
+    _write_encoding(str(tmp_path), lengths=[3, 2, 6, 4, 5], patient_ids=[1, 1, 2, 2, 3])
+    patients = PatientDataset(EncodedDataset(str(tmp_path)))
+
+    # lists of single patients, as DataLoader passes them on torch versions without __getitems__
+    batch = collate_patients([patients[0], patients[2]])
+    assert batch['input_ids'].shape == (3, 5)
+    assert batch['attn_masks'].sum(1).tolist() == [3, 2, 5]
+    assert batch['chunk_counts'].tolist() == [2, 1]
+    assert batch['patient_ids'].tolist() == [1, 3]
+
+    # same batch as when it's gathered in one go
+    gathered = collate_patients(patients.__getitems__([0, 2]))
+    for name in gathered:
+        assert torch.equal(batch[name], gathered[name])
+
+
+def test_select_windows_policies_and_stride():
+    # windows of 4 tokens sharing 1, the last one of a note aligned with its end
+    lengths = [3, 10]
+    for policy, notes, starts in [
+        ('all', [0, 1, 1, 1], [0, 0, 3, 6]),
+        ('head', [0, 1], [0, 0]),
+        ('tail', [0, 1], [0, 6]),
+        ('head+tail', [0, 1, 1], [0, 0, 6])
+    ]:
+        note, start = select_windows(lengths, 4, stride=1, policy=policy)
+        assert note.tolist() == notes and start.tolist() == starts
+
+    # without stride the windows don't overlap but for the last one
+    _, start = select_windows([11], 4)
+    assert start.tolist() == [0, 4, 7]
+    # at most max_note_chunks windows from the start of each note
+    note, start = select_windows(lengths, 4, stride=1, max_note_chunks=2)
+    assert note.tolist() == [0, 1, 1] and start.tolist() == [0, 0, 3]
+
+
+def test_build_sequences():
+    token_ids = [[11, 12, 13], [], list(range(21, 31))]
+    input_ids, attn_masks, note = build_sequences(token_ids, 6, cls_id=1, sep_id=2, pad_id=0, policy='head+tail')
+    assert input_ids.tolist() == [
+        [1, 11, 12, 13, 2, 0],
+        [1, 2, 0, 0, 0, 0],
+        [1, 21, 22, 23, 24, 2],
+        [1, 27, 28, 29, 30, 2]
+    ]
+    assert attn_masks.sum(1).tolist() == [5, 2, 6, 6]
+    assert note.tolist() == [0, 1, 2, 2]
+
+    input_ids, _, note = build_sequences(token_ids[2:], 6, cls_id=1, sep_id=2, pad_id=0, stride=1)
+    assert input_ids[:, 1:-1].tolist() == [[21, 22, 23, 24], [24, 25, 26, 27], [27, 28, 29, 30]]
+    assert note.tolist() == [0, 0, 0]
+
+
+def test_bucket_batches_cover_every_sequence_across_processes():
+    lengths = np.random.RandomState(0).randint(1, 100, 25)
+    epochs = []
+    for epoch in range(2):
+        batches = []
+        for rank in range(2):
+            sampler = DistributedSampler(range(len(lengths)), num_replicas=2, rank=rank, shuffle=True, seed=0)
+            batch_sampler = BucketBatchSampler(sampler, lengths, batch_size=4, bucket_size_multiplier=2)
+            batch_sampler.epoch = epoch
+            rank_batches = list(batch_sampler)
+            assert len(rank_batches) == len(batch_sampler) == 4
+            batches += rank_batches
+        # DistributedSampler pads 25 sequences to 26 with the first one of its shuffle, 13 per process
+        drawn = sum(batches, [])
+        assert len(drawn) == 26 and sorted(set(drawn)) == list(range(25))
+        # pools of 2 batches are sorted by length, so the shorter batch of a pool is all shorter than the other
+        for rank_batches in [batches[:4], batches[4:]]:
+            pools = [sorted(rank_batches[i:i+2], key=lambda b:lengths[b].min()) for i in range(0, 4, 2)]
+            for short, long in pools:
+                assert lengths[short].max() <= lengths[long].min()
+        epochs.append(drawn)
+    # set_epoch reshuffles what each process gets
+    assert epochs[0] != epochs[1]
+
+
+def test_patient_sampler_subsample():
+    # patients 1 and 2 readmitted, 3 to 8 not, two sequences each
+    patient_ids = np.repeat(np.arange(1, 9), 2)
+    labels = (patient_ids <= 2).astype(np.int64)
+    for epoch in range(3):
+        drawn = []
+        for rank in range(2):
+            sampler = PatientSampler(labels, patient_ids, mode='subsample', neg_ratio=1.0, num_replicas=2, rank=rank)
+            sampler.set_epoch(epoch)
+            n = len(sampler)
+            drawn += list(sampler)
+            assert len(drawn) == n*(rank+1)
+        # every sequence of the positive patients and of two negative ones, split between the processes
+        assert len(drawn) == 8 and len(set(drawn)) == 8
+        kept = set(patient_ids[drawn].tolist())
+        assert {1, 2} <= kept and len(kept) == 4
+
+
+def test_patient_sampler_weighted():
+    # one readmitted patient among five, with four sequences against one for each of the others
+    patient_ids = np.array([1, 1, 1, 1, 2, 3, 4, 5])
+    labels = (patient_ids == 1).astype(np.int64)
+    sampler = PatientSampler(labels, patient_ids, mode='weighted', num_samples=20000)
+    drawn = np.array(list(sampler))
+    assert len(drawn) == len(sampler) == 20000
+    # both classes drawn as often, each patient's sequences evenly
+    counts = np.bincount(drawn, minlength=len(labels))/len(drawn)
+    assert np.allclose(counts, 1/8, atol=0.01)
+    # a new draw for the next epoch, the same one for the same epoch and seed
+    assert not np.array_equal(np.array(list(sampler)), drawn)
+    again = PatientSampler(labels, patient_ids, mode='weighted', num_samples=20000)
+    assert np.array_equal(np.array(list(again)), drawn)
@@ -0,0 +1,25 @@
+import pytest
+import torch
+
+# lib needs the full training environment (pytorch_lightning...)
+lib = pytest.importorskip('lib')
+
+
+def test_attention_pooling_is_per_patient():
+    torch.manual_seed(0)
+    head = lib.AttentionPoolingHead(8, n_classes=2, attention_size=4).eval()
+    embeddings = torch.randn(6, 8)
+    chunk_counts = torch.tensor([3, 1, 2])
+    logits = head(embeddings, chunk_counts)
+    assert logits.shape == (3, 2)
+
+    # a patient's logits only depend on their own sequences, not on the others or the padding of the batch
+    alone = torch.cat([head(embeddings[:3], torch.tensor([3])), head(embeddings[3:4], torch.tensor([1])),
+                       head(embeddings[4:], torch.tensor([2]))])
+    assert torch.allclose(logits, alone, atol=1e-6)
+    changed = embeddings.clone()
+    changed[:3] = torch.randn(3, 8)
+    assert torch.allclose(head(changed, chunk_counts)[1:], logits[1:], atol=1e-6)
+
+    # a patient with a single sequence is classified from that sequence's embedding
+    assert torch.allclose(logits[1], head.classifier(embeddings[3]), atol=1e-6)
@@ -0,0 +1,156 @@
+import os
+import json
+import shutil
+import argparse
+import numpy as np
+from itertools import chain
+from util import iter_txt_df, file_fingerprint, cache_key
+
+
+TOKENS_FILE = 'tokens.int32'
+META_FILE = 'meta.json'
+
+
+def cache_path(cache_dir, corpus_fp, var, st_aug):
+    '''Directory of the token cache of one text column of a notes file (or store)'''
+    key = cache_key(source=file_fingerprint(corpus_fp), var=var, st_aug=st_aug, tokenizer='whitespace')
+
+    return os.path.join(cache_dir, 'tokens_'+key)
+
+
+def build(corpus_fp, var, st_aug, out_dir, chunksize=1e5):
+    '''
+    Streams the notes, splits them on whitespace and writes the token IDs of all notes one after
+    the other to a flat int32 file, with the offsets of each note in it, the patient ID of each note
+    and the vocabulary (token ID -> word). Only one chunk of notes is in memory at a time.
+    '''
+    # written to a temporary directory first so that an interrupted build isn't mistaken for a cache
+    tmp_dir = out_dir+'.tmp'
+    os.makedirs(tmp_dir, exist_ok=True)
+    vocab = {}
+    lengths, subject_ids = [], []
+    with open(os.path.join(tmp_dir, TOKENS_FILE), 'wb') as token_file:
+        for chunk in iter_txt_df(corpus_fp, var, st_aug, chunksize):
+            notes = chunk[var]+chunk.SEMTYPES if st_aug else chunk[var]
+            split_notes = [note.split() for note in notes]
+            ids = np.fromiter(
+                (vocab.setdefault(t, len(vocab)) for t in chain.from_iterable(split_notes)), dtype=np.int32
+            )
+            ids.tofile(token_file)
+            lengths.append(np.fromiter(map(len, split_notes), dtype=np.int64, count=len(split_notes)))
+            subject_ids.append(chunk.SUBJECT_ID.values.astype(np.int64))
+
+    lengths = np.concatenate(lengths) if len(lengths) > 0 else np.zeros(0, dtype=np.int64)
+    np.save(os.path.join(tmp_dir, 'offsets.npy'), np.r_[0, np.cumsum(lengths)].astype(np.int64))
+    np.save(
+        os.path.join(tmp_dir, 'subject_ids.npy'),
+        np.concatenate(subject_ids) if len(subject_ids) > 0 else np.zeros(0, dtype=np.int64)
+    )
+    with open(os.path.join(tmp_dir, 'vocab.json'), 'w+') as f:
+        # words in order of their token IDs
+        json.dump(sorted(vocab, key=vocab.get), f)
+    with open(os.path.join(tmp_dir, META_FILE), 'w+') as f:
+        json.dump({'source':os.path.abspath(corpus_fp), 'var':var, 'st_aug':st_aug, 'n_notes':len(lengths),
+                   'n_tokens':int(lengths.sum()), 'vocab_size':len(vocab)}, f, indent=1)
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir, out_dir)
+
+    return out_dir
+
+
+class TokenizedCorpus(object):
+    '''
+    Memory-mapped tokenized notes made by build(). Iterating over it yields the notes as lists of
+    words and can be restarted, so it can be passed to gensim's Word2Vec in place of a list of
+    tokenized notes; take() gives a subset of the notes without copying the tokens.
+    '''
+
+    def __init__(self, path, index=None):
+        self.path = path
+        self.tokens = np.memmap(os.path.join(path, TOKENS_FILE), dtype=np.int32, mode='r')\
+            if os.path.getsize(os.path.join(path, TOKENS_FILE)) > 0 else np.zeros(0, dtype=np.int32)
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.subject_ids = np.load(os.path.join(path, 'subject_ids.npy'), mmap_mode='r')
+        with open(os.path.join(path, 'vocab.json'), 'r') as f:
+            self.vocab = np.array(json.load(f), dtype=object)
+        # positions of the notes of this corpus in the cache, None for all of them
+        self.index = None if index is None else np.asarray(index, dtype=np.int64)
+
+    @classmethod
+    def load_or_build(cls, corpus_fp, var, st_aug, cache_dir, chunksize=1e5):
+        path = cache_path(cache_dir, corpus_fp, var, st_aug)
+        if os.path.exists(os.path.join(path, META_FILE)):
+            print('Loading cached tokens from {}...'.format(path))
+        else:
+            print('Tokenizing {} into {}...'.format(corpus_fp, path))
+            build(corpus_fp, var, st_aug, path, chunksize)
+
+        return cls(path)
+
+    def __getstate__(self):
+        # only the path is pickled (e.g. when sent to joblib workers), the files are mapped again on the other side
+        return {'path':self.path, 'index':self.index}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['index'])
+
+    def __len__(self):
+        return len(self.offsets)-1 if self.index is None else len(self.index)
+
+    def _notes(self):
+        return np.arange(len(self.offsets)-1) if self.index is None else self.index
+
+    def take(self, idx):
+        '''Subset of the notes at positions idx of this corpus, sharing its memory maps and vocabulary'''
+        subset = object.__new__(TokenizedCorpus)
+        subset.__dict__.update(self.__dict__)
+        subset.index = self._notes()[np.asarray(idx, dtype=np.int64)]
+
+        return subset
+
+    def patient_ids(self):
+        return np.asarray(self.subject_ids)[self._notes()]
+
+    def lengths(self, start=0, stop=None):
+        '''Number of tokens of the notes from start to stop'''
+        notes = self._notes()[start:stop]
+        return self.offsets[notes+1]-self.offsets[notes]
+
+    def token_ids(self, start=0, stop=None):
+        '''Token IDs of the notes from start to stop, concatenated'''
+        notes = self._notes()[start:stop]
+        if self.index is None and len(notes) > 0:
+            return np.asarray(self.tokens[self.offsets[notes[0]]:self.offsets[notes[-1]+1]])
+        # gather the token ranges of the notes in one indexing operation
+        lengths = self.offsets[notes+1]-self.offsets[notes]
+        ends = np.cumsum(lengths)
+        positions = np.arange(ends[-1] if len(ends) > 0 else 0)+np.repeat(self.offsets[notes]-(ends-lengths), lengths)
+
+        return np.asarray(self.tokens[positions])
+
+    def __getitem__(self, i):
+        g = self._notes()[i]
+        return self.vocab[self.tokens[self.offsets[g]:self.offsets[g+1]]].tolist()
+
+    def __iter__(self, batch_size=1000):
+        # words are looked up a batch of notes at a time
+        for start in range(0, len(self), batch_size):
+            words = self.vocab[self.token_ids(start, start+batch_size)].tolist()
+            ends = np.cumsum(self.lengths(start, start+batch_size)).tolist()
+            for a, b in zip([0]+ends[:-1], ends):
+                yield words[a:b]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='''Tokenizes a text column of notes .csv files (or stores)
+        into the token cache used by the Word2Vec pipeline''')
+    parser.add_argument('corpus_fps', type=str, nargs='+')
+    parser.add_argument('var', type=str)
+    parser.add_argument('cache_dir', type=str)
+    parser.add_argument('--st_aug', action='store_true')
+    parser.add_argument('--chunksize', type=int, default=100000)
+    args = parser.parse_args()
+
+    for corpus_fp in args.corpus_fps:
+        TokenizedCorpus.load_or_build(corpus_fp, args.var, args.st_aug, args.cache_dir, args.chunksize)
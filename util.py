@@ -1,6 +1,12 @@
+import os
+import json
+import numpy as np
+from time import process_time
+from hashlib import sha1
 from pandas import read_csv, isna
 
-def load_txt_df(fp, var, st_aug, _slice=None):
+
+def _txt_cols(var, st_aug):
     cols = ['SUBJECT_ID', 'HADM_ID', var]
     types = {
         'SUBJECT_ID':int,
@@ -10,13 +16,161 @@ def load_txt_df(fp, var, st_aug, _slice=None):
     if st_aug:
         cols.append('SEMTYPES')
         types['SEMTYPES'] = str
-    df = read_csv(
-        fp,
-        usecols=cols,
-        dtype=types,
-        nrows=_slice
-    )
+
+    return cols, types
+
+
+def _fill_text(df, var, st_aug):
     if sum(isna(df[var])) > 0:
         df[var] = df[var].fillna('')
+    if st_aug and sum(isna(df['SEMTYPES'])) > 0:
+        df['SEMTYPES'] = df['SEMTYPES'].fillna('')
 
     return df
+
+
+def load_txt_df(fp, var, st_aug, _slice=None, subject_ids=None):
+    '''Reads the notes, optionally only those of the patients in subject_ids (which a columnar store
+    filters as it reads rather than after)'''
+    cols, types = _txt_cols(var, st_aug)
+    if os.path.isdir(fp):
+        # columnar store made by corpus_store.py - only the needed columns are read
+        from corpus_store import load_columns
+
+        df = load_columns(fp, cols, subject_ids=subject_ids, nrows=_slice)
+    else:
+        df = read_csv(
+            fp,
+            usecols=cols,
+            dtype=types,
+            nrows=_slice
+        )
+        if subject_ids is not None:
+            df = df[df.SUBJECT_ID.isin(subject_ids)]
+
+    return _fill_text(df, var, st_aug)
+
+
+def iter_txt_df(fp, var, st_aug, chunksize, subject_ids=None):
+    '''Same as load_txt_df but yields the notes in chunks'''
+    cols, types = _txt_cols(var, st_aug)
+    chunksize = int(chunksize)
+    if os.path.isdir(fp):
+        from corpus_store import iter_columns
+
+        for chunk in iter_columns(fp, cols, chunksize, subject_ids=subject_ids):
+            yield _fill_text(chunk, var, st_aug)
+    else:
+        for chunk in read_csv(fp, usecols=cols, dtype=types, chunksize=chunksize):
+            if subject_ids is not None:
+                chunk = chunk[chunk.SUBJECT_ID.isin(subject_ids)]
+                if len(chunk) == 0:
+                    continue
+            yield _fill_text(chunk, var, st_aug)
+
+
+def file_fingerprint(fp):
+    '''Cheap fingerprint of an input file (or store directory) from its path, size and
+    modification time, used to key on-disk caches of things computed from it'''
+    fp = os.path.abspath(fp)
+    if os.path.isdir(fp):
+        entries = sorted(os.listdir(fp))
+        stats = [(e, os.path.getsize(os.path.join(fp, e)), os.path.getmtime(os.path.join(fp, e))) for e in entries]
+    else:
+        stats = [(os.path.getsize(fp), os.path.getmtime(fp))]
+
+    return [fp, stats]
+
+
+def cache_key(**parts):
+    '''Short hash of a set of JSON-serialisable settings, to name a cache directory'''
+    return sha1(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def timed(fn, *args):
+    '''Runs fn(*args) and returns its result along with the CPU-seconds it took and the process it ran in'''
+    start = process_time()
+    result = fn(*args)
+
+    return result, process_time()-start, os.getpid()
+
+
+def cpu_seconds(start, timings):
+    '''
+    CPU-seconds spent in this process since process_time() returned start, plus those of the timed
+    calls (CPU-seconds, process ID) that ran in other processes, e.g. joblib's worker processes -
+    calls run in this process (sequentially or in threads) are already counted by process_time
+    '''
+    pid = os.getpid()
+
+    return process_time()-start+sum(t for t, p in timings if p != pid)
+
+
+def stratified_subsample(labels, fraction, seed):
+    '''
+    Sorted indices of a random fraction of labels with the same class balance. For a given seed a
+    smaller fraction is always a subset of a larger one.
+    '''
+    labels = np.asarray(labels)
+    rng = np.random.RandomState(seed)
+    keep = []
+    for c in np.unique(labels):
+        idx = rng.permutation(np.flatnonzero(labels == c))
+        keep.append(idx[:max(1, int(np.ceil(fraction*len(idx))))])
+
+    return np.sort(np.concatenate(keep))
+
+
+def balanced_weights(labels, groups=None):
+    '''
+    Sample weights under which every class has the same total weight, n/(n_classes*class count) per
+    sample as in sklearn's 'balanced' class weights. With groups (e.g. the patient ID of each sequence)
+    the classes are counted in groups, and each group's weight is split evenly between its samples so
+    that patients with many sequences don't count for more than the others.
+    '''
+    labels = np.asarray(labels)
+    classes, codes = np.unique(labels, return_inverse=True)
+    if groups is None:
+        return (len(labels)/(len(classes)*np.bincount(codes)))[codes]
+
+    _, group_codes, group_sizes = np.unique(groups, return_inverse=True, return_counts=True)
+    # class of each group, groups being all of one class
+    group_classes = np.zeros(len(group_sizes), dtype=np.int64)
+    group_classes[group_codes] = codes
+    group_weights = len(group_sizes)/(len(classes)*np.bincount(group_classes, minlength=len(classes)))[group_classes]
+
+    return (group_weights/group_sizes)[group_codes]
+
+
+def halving_budgets(eta, n_rungs):
+    '''Training set fractions of each round of successive halving, e.g. 1/9, 1/3, 1 for eta=3 and 3 rounds'''
+    return [float(eta)**-i for i in range(n_rungs-1, -1, -1)]
+
+
+def successive_halving(configs, evaluate, budgets, eta=3, tol=None):
+    '''
+    Budgeted hyperparameter search: evaluate(configs, budget) scores a list of configurations at a
+    given budget (higher is better, AUROC here). Every configuration is scored at the first budget and
+    only the best 1/eta are carried on to the next, until the last budget or a single configuration is
+    left. If tol is given the search also stops once the best score improves by less than tol from one
+    budget to the next, as more budget is then not changing the ranking much.
+    Returns the best configuration, its score and a list of (budget, configuration, score) for every evaluation.
+    '''
+    survivors = list(configs)
+    history = []
+    prev_best = None
+    for rung, budget in enumerate(budgets):
+        scores = np.asarray(evaluate(survivors, budget), dtype=float)
+        history += [(budget, c, s) for c, s in zip(survivors, scores)]
+        order = np.argsort(-scores, kind='mergesort')
+        best, best_score = survivors[order[0]], scores[order[0]]
+        print('Budget {:.3g}: {} configurations, best AUROC {:.4f}'.format(budget, len(survivors), best_score))
+        if rung == len(budgets)-1 or len(survivors) == 1:
+            break
+        if tol is not None and prev_best is not None and best_score-prev_best < tol:
+            print('Best AUROC improved by less than {}, stopping early'.format(tol))
+            break
+        prev_best = best_score
+        survivors = [survivors[i] for i in order[:max(1, len(survivors)//eta)]]
+
+    return best, best_score, history
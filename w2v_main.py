@@ -14,7 +14,10 @@ def main(args):
     model = MIMICWord2VecReadmissionPredictor(
         txtvar=args.txtvar,
         st_aug=args.st,
-        db=args.db
+        db=args.db,
+        patient_pooling=args.pooling,
+        token_cache=args.token_cache,
+        subword=args.subword
     )
 
     print('Running Parameter Grid Search...\n')
@@ -22,7 +25,11 @@ def main(args):
         args.train_txt_fp,
         args.train_readm_fp,
         n_jobs=args.workers,
-        use_multithreading=args.multithread
+        use_multithreading=args.multithread,
+        search=args.search,
+        eta=args.eta,
+        n_rungs=args.rungs,
+        tol=args.search_tol
     )
 
     print('Training on patient dataset...\n')
@@ -57,6 +64,20 @@ if __name__ == '__main__':
     parser.add_argument('-out_fp', type=str)
     parser.add_argument('-model_fp', type=str)
     parser.add_argument('-workers', type=int, default=-1)
+    parser.add_argument('-pooling', type=str, default='mean', choices=['mean', 'max', 'weighted'],
+        help='how note vectors are pooled for each patient (weighted = mean weighted by note length)')
     parser.add_argument('-multithread', action='store_true')
+    parser.add_argument('-token_cache', type=str, default=None,
+        help='''directory in which to cache the notes split on whitespace (enough for cleaned text, TERM or CUI) -
+        later runs on the same file map the cached token IDs instead of tokenizing again''')
+    parser.add_argument('-subword', action='store_true',
+        help='train FastText embeddings, whose subword vectors are used for test words that are not in the vocabulary')
+    parser.add_argument('-search', type=str, default='grid', choices=['grid', 'halving'],
+        help='exhaustive grid search, or successive halving over growing subsamples of the training patients')
+    parser.add_argument('-eta', type=int, default=3,
+        help='fraction of configurations kept, and growth of the subsample, at each round of successive halving')
+    parser.add_argument('-rungs', type=int, default=3, help='number of rounds of successive halving')
+    parser.add_argument('-search_tol', type=float, default=None,
+        help='stop successive halving early once the best AUROC improves by less than this between rounds')
 
     main(parser.parse_args())